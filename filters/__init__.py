@@ -1,4 +1,19 @@
-from .backstory_consistency_validation_filter import backstory_consistency_validation_filter
-from .chapter_level_causal_chain_validation_filter import chapter_level_causal_chain_validation_filter
-from .section_level_causal_chain_validation_filter import section_level_causal_chain_validation_filter
-from .style_filter import style_filter 
+from .backstory_consistency_validation_filter import (
+    backstory_consistency_validation_filter,
+    build_backstory_consistency_validation_filter_prompt,
+)
+from .chapter_level_causal_chain_validation_filter import (
+    chapter_level_causal_chain_validation_filter,
+    build_chapter_level_causal_chain_validation_filter_prompt,
+)
+from .section_level_causal_chain_validation_filter import (
+    section_level_causal_chain_validation_filter,
+    build_section_level_causal_chain_validation_filter_prompt,
+)
+from .style_filter import (
+    style_filter,
+    section_style_filter,
+    build_style_filter_prompt,
+    build_section_style_filter_prompt,
+    STYLE_FILTER_MODEL,
+)
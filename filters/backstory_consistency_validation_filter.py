@@ -1,6 +1,41 @@
-from typing import Dict, Any
+from typing import Tuple
+from utils import build_story_context
+from .two_stage_validation import two_stage_validation
 
-def backstory_consistency_validation_filter(
+def build_backstory_consistency_validation_filter_prompt(
+    master_plot: str,
+    backstories: str,
+    characters: str,
+    plot: str,
+    intent: str
+) -> Tuple[str, str]:
+    """
+    backstory_consistency_validation_filter のプロンプトを組み立てる。
+    Batch API 経由でまとめて実行する場合にも同じプロンプトを使う。
+    
+    Args:
+        master_plot (str): マスタープロット
+        backstories (str): 世界観設定
+        characters (str): キャラクター設定
+        plot (str): チェック対象のプロット
+        intent (str): チェック対象の意図
+        
+    Returns:
+        Tuple[str, str]: システムプロンプトとユーザープロンプト
+    """
+    system_prompt = build_story_context(master_plot, backstories, characters)
+    prompt = f"""
+    対象plot:
+    {plot}
+    対象intent:
+    {intent}
+
+    矛盾がないかチェック。
+    問題あれば指摘、なければOK。
+    """
+    return system_prompt, prompt
+
+async def backstory_consistency_validation_filter(
     master_plot: str,
     backstories: str,
     characters: str,
@@ -21,5 +56,8 @@ def backstory_consistency_validation_filter(
     Returns:
         str: バリデーション結果。問題なければ "OK" を含む
     """
-    # TODO: Implement actual validation logic
-    return "OK" 
+    system_prompt, prompt = build_backstory_consistency_validation_filter_prompt(
+        master_plot, backstories, characters, plot, intent
+    )
+    validation_output = await two_stage_validation(system_prompt, prompt)
+    return validation_output
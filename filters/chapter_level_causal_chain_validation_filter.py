@@ -1,11 +1,47 @@
-from typing import List, Dict, Any
+from typing import Tuple
+from utils import build_story_context
+from .two_stage_validation import two_stage_validation
 
-def chapter_level_causal_chain_validation_filter(
+def build_chapter_level_causal_chain_validation_filter_prompt(
     master_plot: str,
     backstories: str,
-    all_characters_timeline: List[Dict[str, Any]],
+    all_characters_timeline_json: str,
     characters: str,
-    chapter_plots: List[str]
+    chapter_plots_json: str
+) -> Tuple[str, str]:
+    """
+    chapter_level_causal_chain_validation_filter のプロンプトを組み立てる。
+    Batch API 経由でまとめて実行する場合にも同じプロンプトを使う。
+    
+    Args:
+        master_plot (str): マスタープロット
+        backstories (str): 世界観設定
+        all_characters_timeline_json (str): 呼び出し側でシリアライズ済みの全キャラクタータイムライン（JSON）
+        characters (str): キャラクター設定
+        chapter_plots_json (str): 呼び出し側でシリアライズ済みの全チャプタープロット（JSON）
+        
+    Returns:
+        Tuple[str, str]: システムプロンプトとユーザープロンプト
+    """
+    system_prompt = build_story_context(master_plot, backstories, characters)
+    prompt = f"""
+    全キャラクタータイムライン:
+    {all_characters_timeline_json}
+
+    全てのChapter Plot:
+    {chapter_plots_json}
+
+    全体の因果関係に矛盾がないかチェック。
+    問題あれば指摘、なければOK。
+    """
+    return system_prompt, prompt
+
+async def chapter_level_causal_chain_validation_filter(
+    master_plot: str,
+    backstories: str,
+    all_characters_timeline_json: str,
+    characters: str,
+    chapter_plots_json: str
 ) -> str:
     """
     出力が因果律に沿っているかをバリデーションするフィルター。
@@ -14,12 +50,15 @@ def chapter_level_causal_chain_validation_filter(
     Args:
         master_plot (str): マスタープロット
         backstories (str): 世界観設定
-        all_characters_timeline (List[Dict[str, Any]]): 全キャラクタータイムライン
+        all_characters_timeline_json (str): 呼び出し側でシリアライズ済みの全キャラクタータイムライン（JSON）
         characters (str): キャラクター設定
-        chapter_plots (List[str]): 全チャプタープロット
+        chapter_plots_json (str): 呼び出し側でシリアライズ済みの全チャプタープロット（JSON）
         
     Returns:
         str: バリデーション結果。問題なければ "OK" を含む
     """
-    # TODO: Implement actual validation logic
-    return "OK" 
+    system_prompt, prompt = build_chapter_level_causal_chain_validation_filter_prompt(
+        master_plot, backstories, all_characters_timeline_json, characters, chapter_plots_json
+    )
+    validation_output = await two_stage_validation(system_prompt, prompt)
+    return validation_output
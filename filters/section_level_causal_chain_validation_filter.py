@@ -1,9 +1,51 @@
-from typing import List, Dict, Any
+from typing import List, Tuple
+import orjson
+from utils import build_story_context
+from .two_stage_validation import two_stage_validation
 
-def section_level_causal_chain_validation_filter(
+def build_section_level_causal_chain_validation_filter_prompt(
     master_plot: str,
     backstories: str,
-    all_characters_timeline: List[Dict[str, Any]],
+    all_characters_timeline_json: str,
+    characters: str,
+    chapter_plot: str,
+    section_plots: List[str]
+) -> Tuple[str, str]:
+    """
+    section_level_causal_chain_validation_filter のプロンプトを組み立てる。
+    Batch API 経由でまとめて実行する場合にも同じプロンプトを使う。
+    
+    Args:
+        master_plot (str): マスタープロット
+        backstories (str): 世界観設定
+        all_characters_timeline_json (str): 呼び出し側でシリアライズ済みの全キャラクタータイムライン（JSON）
+        characters (str): キャラクター設定
+        chapter_plot (str): 現在のチャプタープロット
+        section_plots (List[str]): 現在のチャプターの全セクションプロット
+        
+    Returns:
+        Tuple[str, str]: システムプロンプトとユーザープロンプト
+    """
+    system_prompt = build_story_context(master_plot, backstories, characters)
+    prompt = f"""
+    全キャラクタータイムライン:
+    {all_characters_timeline_json}
+
+    Chapter Plot:
+    {chapter_plot}
+
+    全てのSection Plot:
+    {orjson.dumps(section_plots).decode()}
+
+    章内の因果関係に矛盾がないかチェック。
+    問題あれば指摘、なければOK。
+    """
+    return system_prompt, prompt
+
+async def section_level_causal_chain_validation_filter(
+    master_plot: str,
+    backstories: str,
+    all_characters_timeline_json: str,
     characters: str,
     chapter_plot: str,
     section_plots: List[str]
@@ -15,7 +57,7 @@ def section_level_causal_chain_validation_filter(
     Args:
         master_plot (str): マスタープロット
         backstories (str): 世界観設定
-        all_characters_timeline (List[Dict[str, Any]]): 全キャラクタータイムライン
+        all_characters_timeline_json (str): 呼び出し側でシリアライズ済みの全キャラクタータイムライン（JSON）
         characters (str): キャラクター設定
         chapter_plot (str): 現在のチャプタープロット
         section_plots (List[str]): 現在のチャプターの全セクションプロット
@@ -23,5 +65,8 @@ def section_level_causal_chain_validation_filter(
     Returns:
         str: バリデーション結果。問題なければ "OK" を含む
     """
-    # TODO: Implement actual validation logic
-    return "OK" 
+    system_prompt, prompt = build_section_level_causal_chain_validation_filter_prompt(
+        master_plot, backstories, all_characters_timeline_json, characters, chapter_plot, section_plots
+    )
+    validation_output = await two_stage_validation(system_prompt, prompt)
+    return validation_output
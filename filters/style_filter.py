@@ -1,4 +1,59 @@
-def style_filter(paragraph: str) -> str:
+from typing import List
+import os
+from pydantic import BaseModel, ConfigDict, ValidationError
+from utils import LLM_MODEL, LLMCallError, acall_llm, evict_llm_cache
+
+# スタイルフィルターに使うモデル（環境変数 STYLE_FILTER_MODEL で変更可能）。
+# 文体の書き換えは最終的な本文になるので、安価なモデル（gpt-4o-mini など）は出力の質を確かめてから指定する
+STYLE_FILTER_MODEL = os.getenv("STYLE_FILTER_MODEL", LLM_MODEL)
+
+class SectionStyleOutput(BaseModel):
+    """
+    セクション単位のスタイルフィルターの LLM 出力スキーマ
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    styled_paragraphs: List[str]
+
+# Structured Outputs に渡すスキーマはモジュール読み込み時に一度だけ生成する
+SECTION_STYLE_OUTPUT_SCHEMA = SectionStyleOutput.model_json_schema()
+
+def build_style_filter_prompt(paragraph: str) -> str:
+    """
+    スタイルフィルターのプロンプトを組み立てる。
+    Batch API 経由でまとめて実行する場合にも同じプロンプトを使う。
+    
+    Args:
+        paragraph (str): 入力段落
+        
+    Returns:
+        str: LLM に送信するプロンプト
+    """
+    return f"""
+    以下の段落の文体を整えてください:
+    {paragraph}
+    """
+
+def build_section_style_filter_prompt(paragraphs: List[str]) -> str:
+    """
+    セクション内の複数の段落を1回のリクエストで整えるためのプロンプトを組み立てる。
+    
+    Args:
+        paragraphs (List[str]): セクション内の段落のリスト
+        
+    Returns:
+        str: LLM に送信するプロンプト
+    """
+    numbered_paragraphs = "\n\n".join(f"[{i+1}]\n{paragraph}" for i, paragraph in enumerate(paragraphs))
+    return f"""
+    以下の番号付きの段落それぞれについて、文体を整えてください。
+    段落同士が一続きの文章として自然につながるよう、文体を揃えてください。
+    段落の分割や順序は変えず、整えた{len(paragraphs)}個の段落を順番どおりに styled_paragraphs のJSON配列として出力してください。
+
+{numbered_paragraphs}
+    """
+
+async def style_filter(paragraph: str) -> str:
     """
     文体を修正するフィルター。
     Paragraph に対して適用される。
@@ -7,7 +62,44 @@ def style_filter(paragraph: str) -> str:
         paragraph (str): 入力段落
         
     Returns:
-        str: スタイル修正された段落
+        str: スタイル修正された段落（LLM 呼び出しに失敗した場合は入力段落のまま）
+    """
+    prompt = build_style_filter_prompt(paragraph)
+    try:
+        styled_paragraph = await acall_llm(prompt, cache=True, model=STYLE_FILTER_MODEL)
+    except LLMCallError as e:
+        # 文体の修正は本文の内容を変えないので、失敗した場合は修正前の段落をそのまま使う
+        print(f"スタイルフィルターに失敗したため、修正前の段落を使います: {e}")
+        return paragraph
+    return styled_paragraph
+
+async def section_style_filter(paragraphs: List[str]) -> List[str]:
     """
-    # TODO: Implement actual style filtering logic
-    return paragraph 
+    セクション内の全段落の文体を1回のリクエストでまとめて修正するフィルター。
+    共通の指示を段落ごとに送り直さずに済み、段落間の文体も揃う。
+    
+    Args:
+        paragraphs (List[str]): セクション内の段落のリスト
+        
+    Returns:
+        List[str]: スタイル修正された段落のリスト（入力と同じ順序・個数）
+        
+    Raises:
+        ValueError: JSONパースエラーや段落数が一致しない場合
+        LLMCallError: リトライを使い切っても LLM 呼び出しが成功しなかった場合
+    """
+    prompt = build_section_style_filter_prompt(paragraphs)
+    response = await acall_llm(prompt, json_mode=True, cache=True, json_schema=SECTION_STYLE_OUTPUT_SCHEMA, model=STYLE_FILTER_MODEL)
+    
+    # 不正な応答をキャッシュに残すと、再実行のたびに同じ失敗から段落ごとのリクエストに戻ってしまうので削除する
+    try:
+        styled_paragraphs = SectionStyleOutput.model_validate_json(response).styled_paragraphs
+    except ValidationError as e:
+        evict_llm_cache(prompt, json_mode=True, json_schema=SECTION_STYLE_OUTPUT_SCHEMA, model=STYLE_FILTER_MODEL)
+        raise ValueError(f"JSONパースに失敗しました: {e}\nレスポンス: {response[:100]}...")
+    
+    if len(styled_paragraphs) != len(paragraphs):
+        evict_llm_cache(prompt, json_mode=True, json_schema=SECTION_STYLE_OUTPUT_SCHEMA, model=STYLE_FILTER_MODEL)
+        raise ValueError(f"段落数が一致しません: 入力 {len(paragraphs)} 個に対して出力 {len(styled_paragraphs)} 個")
+    
+    return styled_paragraphs
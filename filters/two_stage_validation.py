@@ -0,0 +1,69 @@
+from utils import acall_llm, LLMCallError, LLM_FAST_MODEL
+
+# 一次判定で返させる出力の上限トークン数（"OK" か "FLAG: <理由の要約>" だけを返させる）
+TRIAGE_MAX_TOKENS = 32
+
+def build_triage_prompt(prompt: str) -> str:
+    """
+    バリデーションのプロンプトを、安価なモデル向けの一次判定プロンプトに変換する。
+    
+    Args:
+        prompt (str): バリデーションフィルターのユーザープロンプト
+        
+    Returns:
+        str: 一次判定用のプロンプト
+    """
+    return f"""{prompt}
+    回答は次のどちらか一行のみとしてください。
+    問題がなければ: OK
+    問題があれば: FLAG: <問題点の要約>
+    """
+
+def build_diagnosis_prompt(prompt: str, triage_output: str) -> str:
+    """
+    一次判定で問題が指摘された場合に、フラッグシップモデルへ送る詳細診断プロンプトを組み立てる。
+    
+    Args:
+        prompt (str): バリデーションフィルターのユーザープロンプト
+        triage_output (str): 一次判定の出力
+        
+    Returns:
+        str: 詳細診断用のプロンプト
+    """
+    return f"""{prompt}
+    一次チェックで次の指摘がありました:
+    {triage_output}
+
+    この指摘が妥当かを確認し、問題があれば具体的に指摘してください。問題がなければOK。
+    """
+
+async def two_stage_validation(system_prompt: str, prompt: str) -> str:
+    """
+    バリデーションを2段階で行う。
+    まず安価なモデル（LLM_FAST_MODEL）に OK / FLAG のみを判定させ、
+    FLAG（または判定不能）の場合だけフラッグシップモデルで詳細に診断する。
+    大半の呼び出しは OK で終わるため、バリデーション全体のコストとレイテンシを抑えられる。
+    
+    Args:
+        system_prompt (str): 物語設定のシステムプロンプト
+        prompt (str): バリデーションフィルターのユーザープロンプト
+        
+    Returns:
+        str: バリデーション結果。問題なければ "OK" を含む。
+            LLM 呼び出しに失敗した場合は検証できなかった旨を返す（検証結果は表示するだけなので生成は止めない）
+    """
+    try:
+        triage_output = await acall_llm(
+            build_triage_prompt(prompt),
+            cache=True,
+            system_prompt=system_prompt,
+            model=LLM_FAST_MODEL,
+            temperature=0,
+            max_tokens=TRIAGE_MAX_TOKENS,
+        )
+        if triage_output.strip().upper().startswith("OK"):
+            return "OK"
+        
+        return await acall_llm(build_diagnosis_prompt(prompt, triage_output), cache=True, system_prompt=system_prompt)
+    except LLMCallError as e:
+        return f"検証を実行できませんでした: {e}"
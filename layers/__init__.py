@@ -2,9 +2,9 @@ from .plot_layer import plot_layer
 from .backstory_layer import backstory_layer
 from .character_layer import character_layer
 from .chapter_layer import chapter_layer
-from .timeline_layer import timeline_layer
+from .timeline_layer import timeline_layer, select_relevant_timeline
 from .section_layer import section_layer
-from .paragraph_layer import paragraph_layer
+from .paragraph_layer import paragraph_layer, summarize_previous_paragraphs, PREVIOUS_PARAGRAPHS_MAX_COUNT
 
 __all__ = [
     'plot_layer',
@@ -12,6 +12,9 @@ __all__ = [
     'character_layer',
     'chapter_layer',
     'timeline_layer',
+    'select_relevant_timeline',
     'section_layer',
     'paragraph_layer',
+    'summarize_previous_paragraphs',
+    'PREVIOUS_PARAGRAPHS_MAX_COUNT',
 ] 
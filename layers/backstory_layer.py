@@ -1,7 +1,7 @@
 from typing import Optional
-from utils import call_llm
+from utils import LLM_CACHE_GENERATIVE, acall_llm, build_story_context
 
-def backstory_layer(master_plot: str) -> str:
+async def backstory_layer(master_plot: str) -> str:
     """
     Backstory Layer:
     Plot Layer で生成したプロットをベースに世界観の設定を出力するレイヤー。
@@ -14,12 +14,11 @@ def backstory_layer(master_plot: str) -> str:
     Returns:
         str: backstories (物語世界の背景設定)
     """
-    prompt = f"""
+    # マスタープロットは後続の全レイヤーと同じシステムプロンプトの先頭部分に置き、プレフィックスキャッシュを共有する
+    system_prompt = build_story_context(master_plot)
+    prompt = """
     あなたは多層的物語生成システムの一部として、物語の背景設定（バックストーリー）を生成する専門家です。
-    以下のマスタープロットに基づいて、物語の世界観を詳細に描写してください。
-
-    # マスタープロット
-    {master_plot}
+    システムプロンプトのマスタープロットに基づいて、物語の世界観を詳細に描写してください。
 
     # 指示
     以下の要素を含む、マスタープロットと一貫性のある背景設定を生成してください：
@@ -35,5 +34,6 @@ def backstory_layer(master_plot: str) -> str:
     特に、現実世界で一般的でない用語や背景設定については詳細に掘り下げてください。
     """
     
-    backstories = call_llm(prompt)
+    # LLM_CACHE_GENERATIVE=1 の場合のみ、同じ入力での再実行では LLM を呼ばずにキャッシュから返す
+    backstories = await acall_llm(prompt, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt)
     return backstories 
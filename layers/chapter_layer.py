@@ -1,8 +1,84 @@
 from typing import Optional, Tuple, List
-import json
-from utils import call_llm
+from functools import lru_cache
+from pydantic import BaseModel, ConfigDict, ValidationError
+from utils import LLM_CACHE_GENERATIVE, acall_llm, budget_pack, build_story_context, evict_llm_cache
 
-def chapter_layer(
+# プロンプトに全文を含めるこれまでの章のプロットのトークン予算
+PREVIOUS_CHAPTERS_TOKEN_BUDGET = 4000
+
+# 予算から外れた章の一行要約の最大文字数
+OMITTED_CHAPTER_SUMMARY_LENGTH = 80
+
+# 最終章用の特別な指示
+FINAL_CHAPTER_INSTRUCTION = """
+        これは物語の最終章です。すべての物語の主要な要素を解決し、適切な結末に導いてください。
+        オープンエンドにせず、明確な終わりをつけてください。
+        """
+
+class ChapterOutput(BaseModel):
+    """
+    Chapter Layer の LLM 出力スキーマ
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    chapter_plot: str
+    chapter_intent: str
+
+# Structured Outputs に渡すスキーマはモジュール読み込み時に一度だけ生成する
+CHAPTER_OUTPUT_SCHEMA = ChapterOutput.model_json_schema()
+
+# 章によらず不変の指示。ユーザープロンプトの先頭に置き、システムプロンプトと合わせてプレフィックスキャッシュに載せる
+CHAPTER_PROMPT_INSTRUCTIONS = """
+    # チャプター生成タスク
+    
+    あなたは物語の章を生成するアシスタントです。マスタープロットを元に、末尾で指定する章のプロットを詳細に作成してください。
+    
+    ## 制約条件:
+    1. 章のプロットは、マスタープロットのストーリーラインに沿ったものであること
+    2. キャラクターの行動や動機は、設定された性格と一致していること
+    3. 世界観の設定と矛盾しないこと
+    4. プロットは十分な詳細を含み、章の要約として機能すること
+    5. この章で起こる主要なイベント、キャラクターの行動、設定の変化を明確に記述すること
+    6. これまでの章と自然につながるストーリーを作成すること
+    
+    ## 出力形式:
+    JSONフォーマットで以下の情報を出力してください:
+
+    {
+        "chapter_plot": "指定された章のプロット",
+        "chapter_intent": "次の章に向けての意図"
+    }
+"""
+
+# 章ごとに変わる情報を埋め込むテンプレート。呼び出しのたびに f-string を組み立てず、format_map で埋める
+# （出力形式の例に波括弧を含む CHAPTER_PROMPT_INSTRUCTIONS はテンプレートに含めず、連結する）
+CHAPTER_PROMPT_TEMPLATE = """
+    {previous_chapters_info}
+
+    # 指示
+    第{chapter_number}章のプロット（chapter_plot）と、この章から物語を今後どう進めるかの意図（chapter_intent）を生成してください。
+    {final_chapter_instruction}
+    """
+
+@lru_cache(maxsize=256)
+def summarize_chapter_plot(plot: str) -> str:
+    """
+    章のプロットを一行に要約する（冒頭の一文を切り出す）。
+    同じ章は以降の全ての章生成で繰り返し要約されるのでキャッシュする。
+
+    Args:
+        plot (str): 章のプロット
+
+    Returns:
+        str: 一行の要約
+    """
+    first_line = plot.strip().split("\n", 1)[0]
+    first_sentence = first_line.split("。", 1)[0]
+    if len(first_sentence) > OMITTED_CHAPTER_SUMMARY_LENGTH:
+        return first_sentence[:OMITTED_CHAPTER_SUMMARY_LENGTH] + "…"
+    return first_sentence + "。"
+
+async def chapter_layer(
     master_plot: str,
     backstories: str,
     characters: str,
@@ -35,73 +111,56 @@ def chapter_layer(
     chapter_number = chapter_index + 1
     
     # 最終章用の特別な指示
-    final_chapter_instruction = ""
-    if is_final_chapter:
-        final_chapter_instruction = """
-        これは物語の最終章です。すべての物語の主要な要素を解決し、適切な結末に導いてください。
-        オープンエンドにせず、明確な終わりをつけてください。
-        """
+    final_chapter_instruction = FINAL_CHAPTER_INSTRUCTION if is_final_chapter else ""
     
     # これまでの章の情報を生成
-    previous_chapters_info = ""
+    # 章が増えてもプロンプトが際限なく伸びないよう、全文を含めるのはトークン予算に収まる直近の章だけにし、
+    # それより前の章は一行要約にとどめる
+    previous_chapters_parts: List[str] = []
+    first_included_index = 0
     if previous_chapter_plots and len(previous_chapter_plots) > 0:
-        previous_chapters_info += "# これまでの章のプロット\n"
-        for i, plot in enumerate(previous_chapter_plots):
-            previous_chapters_info += f"## 第{i+1}章\n{plot}\n\n"
-    
-    if previous_chapter_intents and len(previous_chapter_intents) > 0:
-        previous_chapters_info += "# これまでの章の意図\n"
-        for i, intent in enumerate(previous_chapter_intents):
-            previous_chapters_info += f"## 第{i+1}章の意図\n{intent}\n\n"
-    
-    # プロンプトの構築
-    prompt = f"""
-    # チャプター生成タスク
-    
-    あなたは物語の章を生成するアシスタントです。マスタープロットを元に、今回の章のプロットを詳細に作成してください。
-    
-    ## 入力情報:
-    
-    # マスタープロット
-    {master_plot}
-    
-    # 世界観設定
-    {backstories}
-    
-    # キャラクター設定
-    {characters}
-
-    {previous_chapters_info}
-
-    # 指示
-    第{chapter_number}章のプロット（chapter_plot）と、この章から物語を今後どう進めるかの意図（chapter_intent）を生成してください。
-    {final_chapter_instruction}
-    
-    ## 制約条件:
-    1. 章のプロットは、マスタープロットのストーリーラインに沿ったものであること
-    2. キャラクターの行動や動機は、設定された性格と一致していること
-    3. 世界観の設定と矛盾しないこと
-    4. プロットは十分な詳細を含み、章の要約として機能すること
-    5. この章で起こる主要なイベント、キャラクターの行動、設定の変化を明確に記述すること
-    6. これまでの章と自然につながるストーリーを作成すること
-    
-    ## 出力形式:
-    JSONフォーマットで以下の情報を出力してください:
-
-    {{
-        "chapter_plot": "第{chapter_number}章のプロット",
-        "chapter_intent": "次の章に向けての意図"
-    }}
-    """
+        recent_plots = budget_pack(previous_chapter_plots, PREVIOUS_CHAPTERS_TOKEN_BUDGET)
+        first_included_index = len(previous_chapter_plots) - len(recent_plots)
+        
+        if first_included_index > 0:
+            previous_chapters_parts.append("# それ以前の章の概要\n")
+            previous_chapters_parts.extend(
+                f"- 第{i+1}章: {summarize_chapter_plot(plot)}\n"
+                for i, plot in enumerate(previous_chapter_plots[:first_included_index])
+            )
+            previous_chapters_parts.append("\n")
+        
+        previous_chapters_parts.append("# これまでの章のプロット\n")
+        previous_chapters_parts.extend(
+            f"## 第{i+1}章\n{plot}\n\n" for i, plot in enumerate(recent_plots, start=first_included_index)
+        )
+    
+    if previous_chapter_intents and len(previous_chapter_intents) > first_included_index:
+        previous_chapters_parts.append("# これまでの章の意図\n")
+        previous_chapters_parts.extend(
+            f"## 第{i+1}章の意図\n{intent}\n\n"
+            for i, intent in enumerate(previous_chapter_intents[first_included_index:], start=first_included_index)
+        )
+    previous_chapters_info = "".join(previous_chapters_parts)
+    
+    # マスタープロット・世界観・キャラクター設定は全呼び出しで不変なのでシステムプロンプトに置き、
+    # ユーザープロンプトも不変の指示を先に、章ごとに変わる情報を後ろに置く（プレフィックスキャッシュを効かせるため）
+    system_prompt = build_story_context(master_plot, backstories, characters)
+    prompt = CHAPTER_PROMPT_INSTRUCTIONS + CHAPTER_PROMPT_TEMPLATE.format_map({
+        "previous_chapters_info": previous_chapters_info,
+        "chapter_number": chapter_number,
+        "final_chapter_instruction": final_chapter_instruction,
+    })
     
     try:
-        # LLMを呼び出してJSONモードでレスポンスを取得
-        response = call_llm(prompt, json_mode=True)
+        # LLMを呼び出し、スキーマで出力形式を強制してレスポンスを取得
+        # LLM_CACHE_GENERATIVE=1 の場合のみ、同じ入力での再実行では LLM を呼ばずにキャッシュから返す
+        response = await acall_llm(prompt, json_mode=True, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt, json_schema=CHAPTER_OUTPUT_SCHEMA)
         
-        # JSONからchapter_plotとchapter_intentを抽出
-        data = json.loads(response)
-        chapter_plot = data.get("chapter_plot", "")
-        chapter_intent = data.get("chapter_intent", "")
+        # JSONのパースとスキーマ検証を一度に行う
+        output = ChapterOutput.model_validate_json(response)
+        chapter_plot = output.chapter_plot
+        chapter_intent = output.chapter_intent
         
         # 値の検証
         if not chapter_plot:
@@ -109,11 +168,13 @@ def chapter_layer(
         if not chapter_intent:
             raise ValueError("'chapter_intent'が見つからないか空です")
     
-    except json.JSONDecodeError as e:
-        # JSONパースに失敗した場合
+    except ValidationError as e:
+        # JSONパースやスキーマ検証に失敗した場合（不正な応答はキャッシュに残さない）
+        evict_llm_cache(prompt, json_mode=True, system_prompt=system_prompt, json_schema=CHAPTER_OUTPUT_SCHEMA)
         raise ValueError(f"JSONパースに失敗しました: {e}\nレスポンス: {response[:100]}...")
     except ValueError as e:
         # 値が不正な場合
+        evict_llm_cache(prompt, json_mode=True, system_prompt=system_prompt, json_schema=CHAPTER_OUTPUT_SCHEMA)
         raise ValueError(f"レスポンスの値が不正です: {e}")
     except Exception as e:
         # その他のエラー
@@ -1,7 +1,7 @@
 from typing import Optional
-from utils import call_llm
+from utils import LLM_CACHE_GENERATIVE, acall_llm, build_story_context
 
-def character_layer(master_plot: str, backstories: str) -> str:
+async def character_layer(master_plot: str, backstories: str) -> str:
     """
     Character Layer:
     Plot Layer で生成したプロットと Backstory Layer で生成した世界観をベースに
@@ -14,15 +14,11 @@ def character_layer(master_plot: str, backstories: str) -> str:
     Returns:
         str: characters (キャラクター設定)
     """
-    prompt = f"""
+    # マスタープロットと背景設定は後続の全レイヤーと同じシステムプロンプトの先頭部分に置き、プレフィックスキャッシュを共有する
+    system_prompt = build_story_context(master_plot, backstories)
+    prompt = """
     あなたは多層的物語生成システムの一部として、物語のキャラクター設定を生成する専門家です。
-    以下のマスタープロットと背景設定に基づいて、物語のキャラクターを詳細に描写してください。
-
-    # マスタープロット
-    {master_plot}
-
-    # 背景設定
-    {backstories}
+    システムプロンプトのマスタープロットと世界観設定に基づいて、物語のキャラクターを詳細に描写してください。
 
     # 指示
     マスタープロットに記載された主要キャラクターとサブキャラクターについて、以下の要素を含む詳細な設定を作成してください：
@@ -39,5 +35,6 @@ def character_layer(master_plot: str, backstories: str) -> str:
     適度な長さ（キャラクターごとに約200-400文字）で、物語を進めるのに十分な詳細を含めてください。
     """
     
-    characters = call_llm(prompt)
+    # LLM_CACHE_GENERATIVE=1 の場合のみ、同じ入力での再実行では LLM を呼ばずにキャッシュから返す
+    characters = await acall_llm(prompt, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt)
     return characters 
@@ -1,16 +1,105 @@
-from typing import List, Dict, Any, Optional, Tuple
-import json
+from typing import Awaitable, Deque, List, Optional, Tuple, Callable
 import os
-from utils import call_llm
+import statistics
+from collections import deque
+from pydantic import BaseModel, ConfigDict, ValidationError
+from utils import LLM_CACHE_GENERATIVE, LLM_FAST_MODEL, LLMCallError, StreamingStringField, acall_llm, acall_llm_candidates, acall_llm_stream, budget_pack, build_story_context, evict_llm_cache
 
-def paragraph_layer(
+# プロンプトに含める直前の段落のトークン予算
+PREVIOUS_PARAGRAPHS_TOKEN_BUDGET = 1500
+
+# 呼び出し側で保持する直前の段落の最大件数（collections.deque の maxlen に使う）。
+# 文体のつながりに必要な直近の段落だけを全文で渡し、それより前の段落は要約（summarize_previous_paragraphs）で渡す
+PREVIOUS_PARAGRAPHS_MAX_COUNT = 2
+
+# それ以前の段落の要約の出力トークン数の上限
+PREVIOUS_PARAGRAPHS_SUMMARY_MAX_TOKENS = 300
+
+# 1回のリクエストでサンプリングする段落の候補数（環境変数 PARAGRAPH_CANDIDATES で変更可能）。
+# 2 以上にすると、候補の中から select_paragraph_candidate で1つを選ぶ（この場合はストリーミングしない）
+PARAGRAPH_CANDIDATE_COUNT = int(os.getenv("PARAGRAPH_CANDIDATES", "1"))
+
+class ParagraphOutput(BaseModel):
+    """
+    Paragraph Layer の LLM 出力スキーマ
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    paragraph: str
+    paragraph_intent: str
+
+# Structured Outputs に渡すスキーマはモジュール読み込み時に一度だけ生成する
+PARAGRAPH_OUTPUT_SCHEMA = ParagraphOutput.model_json_schema()
+
+# 段落によらず不変の指示。ユーザープロンプトの先頭に置き、システムプロンプトと合わせてプレフィックスキャッシュに載せる
+PARAGRAPH_PROMPT_INSTRUCTIONS = """
+    # 段落生成タスク
+    
+    あなたは物語の段落を生成するアシスタントです。セクションプロットをより詳細に肉付けし、流れるような自然な段落テキストを作成してください。
+    生成するテキストは物語の一部として読者に提示される実際のテキストです。
+    
+    1. 流れるような自然な文章で、小説の1パートとして読めるようなクオリティで書いてください
+    2. 前の段落から自然に続くようにしてください。つながりを意識しましょう
+    3. 文体は一貫して、物語世界に没入できるような表現を心がけてください
+    4. 必要に応じて会話や内的独白、ナレーションをバランスよく含めてください
+    5. キャラクターの感情や思考、周囲の環境描写なども含めると良いでしょう
+    
+    ## 出力形式
+    JSONフォーマットで以下の2つの部分を出力してください：
+
+    {
+        "paragraph": "物語の一部分としての段落テキスト",
+        "paragraph_intent": "次の段落でどのように物語を展開したいかの簡潔な意図"
+    }
+"""
+
+# 段落ごとに変わる情報を埋め込むテンプレート。呼び出しのたびに f-string を組み立てず、format_map で埋める
+# （出力形式の例に波括弧を含む PARAGRAPH_PROMPT_INSTRUCTIONS はテンプレートに含めず、連結する）
+PARAGRAPH_PROMPT_TEMPLATE = """
+    ## 入力情報
+
+    [キャラクタータイムライン]
+    {timeline_json}
+
+    [現在のセクションプロット]
+    {section_plot}
+
+    {previous_paragraphs_summary_block}
+
+    [これまでの段落]
+    {previous_paragraphs_info}
+    
+    {paragraph_intent_block}
+
+    ## 指示
+    セクションプロットを元に、段落{paragraph_number}のテキストを詳細に作成してください。
+    """
+
+# 段落の要約で不変の指示
+PREVIOUS_PARAGRAPHS_SUMMARY_PROMPT_INSTRUCTIONS = """以下は物語のセクションのこれまでの要約と、それに続く段落です。
+    後続の段落を書くための前提として、出来事の因果関係、キャラクターの行動と感情の変化、未解決の伏線が分かるように、両者をまとめて200トークン程度の要約にしてください。
+"""
+
+# 要約に畳み込むたびに変わる情報を埋め込むテンプレート
+PREVIOUS_PARAGRAPHS_SUMMARY_PROMPT_TEMPLATE = """
+    [これまでの要約]
+    {previous_summary}
+    
+    [続く段落]
+    {paragraph}
+    """
+
+async def paragraph_layer(
     master_plot: str,
     backstories: str,
     characters: str,
-    all_characters_timeline: List[Dict[str, Any]],
+    timeline_json: str,
     section_plot: str,
-    previous_paragraphs: Optional[List[str]] = None,
-    previous_paragraph_intent: Optional[str] = None
+    previous_paragraphs: Optional[Deque[str]] = None,
+    previous_paragraph_intent: Optional[str] = None,
+    on_paragraph: Optional[Callable[[str], Awaitable[None]]] = None,
+    paragraph_index: Optional[int] = None,
+    previous_paragraphs_summary: Optional[str] = None
 ) -> Tuple[str, str]:
     """
     Paragraph Layer:
@@ -20,16 +109,24 @@ def paragraph_layer(
     1. 入力として受け取ったsection_plotをベースに、paragraph_intentとtimelineデータを参考にする
     2. 前回までの段落との連続性を保ちながら、新しい段落のテキストを生成
     3. 次の段落への意図も一緒に生成
-    4. 生成された段落テキストと意図をモックファイルに保存（テスト用）
     
     Args:
         master_plot (str): マスタープロット
         backstories (str): 世界観の設定
         characters (str): キャラクターの設定
-        all_characters_timeline (List[Dict[str, Any]]): すべてのキャラクターのタイムライン
+        timeline_json (str): 呼び出し側でシリアライズ済みのキャラクタータイムライン（セクションに登場するキャラクターの直近の出来事。select_relevant_timeline の出力）
         section_plot (str): 現在処理中のセクションプロット
-        previous_paragraphs (Optional[List[str]]): 前回までに生成した段落のリスト
+        previous_paragraphs (Optional[Deque[str]]): 直前に生成した段落（古い順）。
+            呼び出し側は deque(maxlen=PREVIOUS_PARAGRAPHS_MAX_COUNT) に追加していけばよい
         previous_paragraph_intent (Optional[str]): 前回の段落の意図
+        on_paragraph (Optional[Callable[[str], Awaitable[None]]]): 指定した場合はレスポンスをストリーミングで受け取り、
+            段落テキストが確定した時点で（意図の生成完了を待たずに）この非同期関数を呼び出して待つ。
+            ストリームを読みながら呼ばれるので、ファイル書き込みなどのブロッキング処理はスレッドに逃がすこと。
+            段落の候補を複数生成する場合はストリーミングせず、選ばれた段落で一度だけ呼び出す
+        paragraph_index (Optional[int]): セクション内の段落番号（0始まり）。
+            previous_paragraphs は件数が頭打ちになるため、省略時のみ len(previous_paragraphs) で代用する
+        previous_paragraphs_summary (Optional[str]): previous_paragraphs より前の段落の要約
+            （summarize_previous_paragraphs で畳み込んだもの）
         
     Returns:
         Tuple[str, str]: 段落と段落の意図
@@ -38,89 +135,147 @@ def paragraph_layer(
         ValueError: JSONパースエラーやレスポンス形式が不正な場合
     """
     if previous_paragraphs is None:
-        previous_paragraphs = []
+        previous_paragraphs = deque()
     
     # 現在の段落番号を特定
-    current_paragraph_index = len(previous_paragraphs)
-    
-    # タイムラインデータの準備
-    timeline_str = json.dumps(all_characters_timeline, ensure_ascii=False, indent=2)
-    # タイムラインが複雑すぎる場合は、最新のエントリだけを使用
-    if len(timeline_str) > 4000:  # 文字数制限を設ける
-        timeline_str = json.dumps(all_characters_timeline[-1] if all_characters_timeline else {}, ensure_ascii=False, indent=2)
+    current_paragraph_index = paragraph_index if paragraph_index is not None else len(previous_paragraphs)
     
-    # 前回の段落内容を文字列化（最新の3つだけ使用）
+    # 前回の段落内容を文字列化（トークン予算に収まる直近の段落だけ使用）
     previous_paragraphs_str = ""
     if previous_paragraphs:
-        # 最新の3つの段落だけを使用
-        recent_paragraphs = previous_paragraphs[-3:] if len(previous_paragraphs) > 3 else previous_paragraphs
-        for i, paragraph in enumerate(recent_paragraphs):
-            paragraph_number = current_paragraph_index - len(recent_paragraphs) + i + 1
-            previous_paragraphs_str += f"\n\nParagraph {paragraph_number}:\n{paragraph}"
-    
-    # プロンプトの構築
-    prompt = f"""
-    # 段落生成タスク
-    
-    あなたは物語の段落を生成するアシスタントです。セクションプロットをより詳細に肉付けし、流れるような自然な段落テキストを作成してください。
-
-    ## 入力情報
-
-    [マスタープロット]
-    {master_plot}
-
-    [世界観設定]
-    {backstories}
-
-    [キャラクター設定]
-    {characters}
-
-    [キャラクタータイムライン]
-    {timeline_str}
-
-    [現在のセクションプロット]
-    {section_plot}
-
-    [これまでの段落]
-    {previous_paragraphs_str if previous_paragraphs_str else "まだ段落は生成されていません。"}
-    
-    {f"[前回の段落意図]\n{previous_paragraph_intent}" if previous_paragraph_intent else ""}
-
-    ## 指示
-    セクションプロットを元に、段落{current_paragraph_index + 1}のテキストを詳細に作成してください。
-    これは物語の一部として読者に提示される実際のテキストです。
-    
-    1. 流れるような自然な文章で、小説の1パートとして読めるようなクオリティで書いてください
-    2. 前の段落から自然に続くようにしてください。つながりを意識しましょう
-    3. 文体は一貫して、物語世界に没入できるような表現を心がけてください
-    4. 必要に応じて会話や内的独白、ナレーションをバランスよく含めてください
-    5. キャラクターの感情や思考、周囲の環境描写なども含めると良いでしょう
+        # 段落の長さに関わらずプロンプトの大きさが一定になるよう、件数ではなくトークン数で切る
+        recent_paragraphs = budget_pack(previous_paragraphs, PREVIOUS_PARAGRAPHS_TOKEN_BUDGET)
+        first_paragraph_number = current_paragraph_index - len(recent_paragraphs) + 1
+        previous_paragraphs_str = "".join(
+            f"\n\nParagraph {paragraph_number}:\n{paragraph}"
+            for paragraph_number, paragraph in enumerate(recent_paragraphs, start=first_paragraph_number)
+        )
     
-    ## 出力形式
-    JSONフォーマットで以下の2つの部分を出力してください：
-
-    {
-        "paragraph": "物語の一部分としての段落テキスト",
-        "paragraph_intent": "次の段落でどのように物語を展開したいかの簡潔な意図"
-    }
-    """
+    # 不変の物語設定はシステムプロンプトに置き、ユーザープロンプトも不変の指示を先に、段落ごとに変わる情報を後ろに置く
+    system_prompt = build_story_context(master_plot, backstories, characters)
+    paragraph_intent_block = f"[前回の段落意図]\n{previous_paragraph_intent}" if previous_paragraph_intent else ""
+    previous_paragraphs_summary_block = f"[それ以前の段落の要約]\n{previous_paragraphs_summary}" if previous_paragraphs_summary else ""
+    prompt = PARAGRAPH_PROMPT_INSTRUCTIONS + PARAGRAPH_PROMPT_TEMPLATE.format_map({
+        "timeline_json": timeline_json,
+        "section_plot": section_plot,
+        "previous_paragraphs_summary_block": previous_paragraphs_summary_block,
+        "previous_paragraphs_info": previous_paragraphs_str if previous_paragraphs_str else "まだ段落は生成されていません。",
+        "paragraph_intent_block": paragraph_intent_block,
+        "paragraph_number": current_paragraph_index + 1,
+    })
     
     # LLMを呼び出して段落を生成
+    # LLM_CACHE_GENERATIVE=1 の場合のみ、同じ入力での再実行では LLM を呼ばずにキャッシュから返す
+    watcher = StreamingStringField("paragraph")
+    if PARAGRAPH_CANDIDATE_COUNT > 1:
+        paragraph, paragraph_intent = await request_paragraph_candidates(prompt, system_prompt, PARAGRAPH_CANDIDATE_COUNT)
+        if on_paragraph is not None:
+            await on_paragraph(paragraph)
+        return paragraph, paragraph_intent
     try:
-        response = call_llm(prompt, json_mode=True)
+        if on_paragraph is None:
+            response = await acall_llm(prompt, json_mode=True, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt, json_schema=PARAGRAPH_OUTPUT_SCHEMA)
+        else:
+            # 段落テキストが閉じた時点で呼び出し側に渡し、残りのデコードと後続処理を重ねる
+            chunks: List[str] = []
+            async for chunk in acall_llm_stream(prompt, json_mode=True, system_prompt=system_prompt, json_schema=PARAGRAPH_OUTPUT_SCHEMA, cache=LLM_CACHE_GENERATIVE):
+                chunks.append(chunk)
+                if (streamed_paragraph := watcher.feed(chunk)) is not None:
+                    await on_paragraph(streamed_paragraph)
+            response = "".join(chunks)
         
         # 最終的な応答からパラグラフと意図を抽出
         paragraph, paragraph_intent = extract_paragraph_and_intent(response)
         
-        # For debugging only - this will be removed in production
-        # save_paragraph_to_mock_files(paragraph, paragraph_intent, current_paragraph_index)
+        # ストリーム中に段落を検出できなかった場合は、ここで確定した段落を渡す
+        if on_paragraph is not None and watcher.value is None:
+            await on_paragraph(paragraph)
         
         return paragraph, paragraph_intent
     except ValueError as e:
         print(f"段落生成中にエラーが発生しました: {e}")
+        # 不正な応答をキャッシュに残すと再実行しても同じ失敗を繰り返すので削除する
+        evict_llm_cache(prompt, json_mode=True, system_prompt=system_prompt, json_schema=PARAGRAPH_OUTPUT_SCHEMA)
         raise
 
 
+async def summarize_previous_paragraphs(previous_summary: Optional[str], paragraph: str) -> str:
+    """
+    直前の段落の窓から外れる段落を、それまでの要約に安価なモデル（LLM_FAST_MODEL）で畳み込む。
+    段落を生成するたびに全ての段落を渡し直さずに済むので、セクション内の段落数によらずプロンプトの大きさが一定になる。
+    
+    Args:
+        previous_summary (Optional[str]): これまでの要約（最初の段落ではNone）
+        paragraph (str): 要約に加える段落
+        
+    Returns:
+        str: 更新された要約
+    """
+    try:
+        return await acall_llm(
+            PREVIOUS_PARAGRAPHS_SUMMARY_PROMPT_INSTRUCTIONS + PREVIOUS_PARAGRAPHS_SUMMARY_PROMPT_TEMPLATE.format_map({
+                "previous_summary": previous_summary or "なし",
+                "paragraph": paragraph,
+            }),
+            cache=True,
+            model=LLM_FAST_MODEL,
+            temperature=0,
+            max_tokens=PREVIOUS_PARAGRAPHS_SUMMARY_MAX_TOKENS,
+        )
+    except LLMCallError as e:
+        # 要約に失敗した場合は段落の冒頭の一文を書き足して代用する
+        print(f"段落の要約に失敗したため、冒頭の一文で代用します: {e}")
+        return (previous_summary or "") + paragraph.strip().split("。", 1)[0] + "。"
+
+async def request_paragraph_candidates(prompt: str, system_prompt: str, n: int) -> Tuple[str, str]:
+    """
+    1回のリクエストで段落の候補を n 個生成し、最も良いものを返す。
+    不正な候補は捨てるので、一部の候補が壊れていても再リクエストせずに済む。
+    
+    Args:
+        prompt (str): ユーザープロンプト
+        system_prompt (str): システムプロンプト（物語コンテキスト）
+        n (int): 候補の数
+        
+    Returns:
+        Tuple[str, str]: 選ばれた段落と段落の意図
+        
+    Raises:
+        ValueError: すべての候補が不正な場合
+    """
+    responses = await acall_llm_candidates(prompt, n, json_mode=True, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt, json_schema=PARAGRAPH_OUTPUT_SCHEMA)
+    
+    candidates: List[Tuple[str, str]] = []
+    errors: List[str] = []
+    for response in responses:
+        try:
+            candidates.append(extract_paragraph_and_intent(response))
+        except ValueError as e:
+            errors.append(str(e))
+    
+    if not candidates:
+        print(f"段落生成中にエラーが発生しました: {errors}")
+        # 不正な応答をキャッシュに残すと再実行しても同じ失敗を繰り返すので削除する
+        evict_llm_cache(prompt, json_mode=True, system_prompt=system_prompt, json_schema=PARAGRAPH_OUTPUT_SCHEMA, n=n)
+        raise ValueError(f"すべての段落候補が不正です: {errors[0] if errors else '候補がありません'}")
+    
+    return select_paragraph_candidate(candidates)
+
+def select_paragraph_candidate(candidates: List[Tuple[str, str]]) -> Tuple[str, str]:
+    """
+    段落の候補から1つを選ぶ。
+    長さが候補の中央値に最も近いものを選び、途中で切れた候補や冗長すぎる候補を避ける。
+    
+    Args:
+        candidates (List[Tuple[str, str]]): 段落と段落の意図の組のリスト（1つ以上）
+        
+    Returns:
+        Tuple[str, str]: 選ばれた段落と段落の意図
+    """
+    median_length = statistics.median(len(paragraph) for paragraph, _ in candidates)
+    return min(candidates, key=lambda candidate: abs(len(candidate[0]) - median_length))
+
+
 def extract_paragraph_and_intent(response: str) -> Tuple[str, str]:
     """
     LLMのレスポンスから段落と段落意図を抽出する
@@ -135,49 +290,19 @@ def extract_paragraph_and_intent(response: str) -> Tuple[str, str]:
         ValueError: JSONパースエラーやレスポンス形式が不正な場合
     """
     try:
-        # JSON形式のレスポンスをパース
-        data = json.loads(response)
-        
-        # キーからデータを取得
-        paragraph = data.get("paragraph", "")
-        paragraph_intent = data.get("paragraph_intent", "")
-        
-        # キーが存在しない、または値が空の場合はエラーを発生
-        if not paragraph:
-            raise ValueError("'paragraph' が見つからないか空です")
-        if not paragraph_intent:
-            raise ValueError("'paragraph_intent' が見つからないか空です")
-            
-    except json.JSONDecodeError as e:
-        # JSONパースに失敗した場合は例外を投げる
+        # JSONのパースとスキーマ検証を一度に行う
+        output = ParagraphOutput.model_validate_json(response)
+    except ValidationError as e:
+        # JSONパースやスキーマ検証に失敗した場合は例外を投げる
         raise ValueError(f"JSONパースに失敗しました: {e}\nレスポンス: {response[:100]}...")
     
+    paragraph = output.paragraph
+    paragraph_intent = output.paragraph_intent
+    
+    # 値が空の場合はエラーを発生
+    if not paragraph:
+        raise ValueError("'paragraph' が見つからないか空です")
+    if not paragraph_intent:
+        raise ValueError("'paragraph_intent' が見つからないか空です")
+    
     return paragraph, paragraph_intent
-
-# Function to be removed as file saving will be centralized in main.py
-# def save_paragraph_to_mock_files(paragraph: str, paragraph_intent: str, paragraph_index: int) -> None:
-#     """
-#     生成された段落と意図をモックファイルに保存する
-#     
-#     Args:
-#         paragraph (str): 段落テキスト
-#         paragraph_intent (str): 段落意図
-#         paragraph_index (int): 段落のインデックス（0から始まる）
-#     """
-#     # 段落を保存
-#     try:
-#         with open(f"paragraph{paragraph_index + 1}-mock.txt", 'w', encoding='utf-8') as f:
-#             f.write(paragraph)
-#         print(f"段落{paragraph_index + 1}を paragraph{paragraph_index + 1}-mock.txt に保存しました")
-#     except Exception as e:
-#         print(f"段落ファイルへの書き込み中にエラーが発生しました: {e}")
-#     
-#     # 段落意図を保存
-#     try:
-#         with open(f"paragraph{paragraph_index + 1}-intent-mock.txt", 'w', encoding='utf-8') as f:
-#             f.write(paragraph_intent)
-#         print(f"段落{paragraph_index + 1}の意図を paragraph{paragraph_index + 1}-intent-mock.txt に保存しました")
-#     except Exception as e:
-#         print(f"意図ファイルへの書き込み中にエラーが発生しました: {e}")
-
-# ... existing code ... 
@@ -1,7 +1,7 @@
 from typing import Optional
-from utils import call_llm
+from utils import LLM_CACHE_GENERATIVE, acall_llm
 
-def plot_layer(user_input: str) -> str:
+async def plot_layer(user_input: str) -> str:
     """
     Plot Layer:
     ユーザーは LLM に大まかな物語の世界観、設定、価値観等を入力する。
@@ -33,5 +33,6 @@ def plot_layer(user_input: str) -> str:
     物語全体を要約できる程度の詳細さを持ちつつも、1つのレスポンスに収まる適度な長さ（約2000文字）にしてください。
     """
     
-    master_plot = call_llm(prompt)
+    # LLM_CACHE_GENERATIVE=1 の場合のみ、同じユーザー入力での再実行では LLM を呼ばずにキャッシュから返す
+    master_plot = await acall_llm(prompt, cache=LLM_CACHE_GENERATIVE)
     return master_plot 
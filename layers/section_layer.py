@@ -1,12 +1,78 @@
-from typing import List, Dict, Any, Optional, Tuple
-import json
-import os
-from utils import call_llm
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable
+import asyncio
+from pydantic import BaseModel, ConfigDict, ValidationError
+from utils import LLM_CACHE_GENERATIVE, LLM_FAST_MODEL, LLM_MODEL, LLMCallError, StreamingStringField, acall_llm, acall_llm_stream, budget_pack, build_story_context, evict_llm_cache
+from .timeline_layer import select_relevant_timeline
 
-import pprint
-pp = pprint.PrettyPrinter(indent=4)
+# プロンプトに全文を含めるこれまでの章のセクションのトークン予算。収まらない古い章は要約に置き換える
+PREVIOUS_SECTIONS_TOKEN_BUDGET = 4000
 
-def section_layer(
+# 章の要約の出力トークン数の上限
+CHAPTER_SYNOPSIS_MAX_TOKENS = 300
+
+class SectionOutput(BaseModel):
+    """
+    Section Layer の LLM 出力スキーマ
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    section_plot: str
+    section_intent: str
+
+# Structured Outputs に渡すスキーマはモジュール読み込み時に一度だけ生成する
+SECTION_OUTPUT_SCHEMA = SectionOutput.model_json_schema()
+
+# セクションによらず不変の指示。ユーザープロンプトの先頭に置き、システムプロンプトと合わせてプレフィックスキャッシュに載せる
+SECTION_PROMPT_INSTRUCTIONS = """
+    # セクション生成タスク
+    
+    あなたは物語の節（セクション）を生成するアシスタントです。「現在の章のプロット」を参考に、「現在の章における前のセクション」から物語が繋がるように、「このセクションの意図」を反映した詳細なセクションプロットを作成してください。セクションの意図の範囲内で物語を詳細化し、続きなどは書かないでください。
+    
+    1. このセクションで起こる主要な出来事、登場するキャラクター、彼らの行動、感情の変化などを詳細に含めてください。
+    2. 時系列、場所の描写、キャラクターの動きが明確になるように記述してください。
+    3. 現在の章のプロットの全体的なテーマを保ちながら、物語を進展させてください。
+    4. 前のセクションとの連続性を保ち、自然な流れを作りましょう。
+    
+    ## 出力形式
+    JSONフォーマットで以下の2つの部分を出力してください：
+
+    {
+        "section_plot": "詳細な物語の一部分としてのプロット。500-1000語程度。",
+        "section_intent": "次のセクションでどのように物語を展開したいかの簡潔な意図（100-200語程度）"
+    }
+"""
+
+# セクションごとに変わる情報を埋め込むテンプレート。呼び出しのたびに f-string を組み立てず、format_map で埋める
+# （出力形式の例に波括弧を含む SECTION_PROMPT_INSTRUCTIONS はテンプレートに含めず、連結する）
+SECTION_PROMPT_TEMPLATE = """
+    ## 入力情報:
+    
+    # 現在の章のプロット
+    {chapter_plot}
+    
+    {timeline_info}
+    
+    {all_content_info}
+    
+    {previous_sections_info}
+    
+    {section_intent_block}
+
+    ## 指示
+    現在の章のプロットを元に、セクション{section_number}のプロットを詳細に作成してください。
+    """
+
+# 章の要約で不変の指示
+CHAPTER_SYNOPSIS_PROMPT_INSTRUCTIONS = """以下は物語の一つの章を構成するセクションのプロットです。
+    後続のセクションを書くための前提として、主要な出来事、キャラクターの行動と変化、未解決の伏線が分かるように、200トークン程度のあらすじに要約してください。
+"""
+
+# 要約する章のセクションを埋め込むテンプレート
+CHAPTER_SYNOPSIS_PROMPT_TEMPLATE = """
+    {sections_text}
+    """
+
+async def section_layer(
     master_plot: str,
     backstories: str,
     characters: str,
@@ -15,7 +81,8 @@ def section_layer(
     previous_sections: Optional[List[str]] = None,
     previous_section_intent: Optional[str] = None,
     all_previous_sections: Optional[List[List[str]]] = None,  # 新規: 全章の全セクションのリスト
-    remaining_chapter_plots: Optional[List[str]] = None  # 新規: まだセクション化されていない章のプロット
+    remaining_chapter_plots: Optional[List[str]] = None,  # 新規: まだセクション化されていない章のプロット
+    on_section_plot: Optional[Callable[[str], Awaitable[None]]] = None
 ) -> Tuple[str, str]:
     """
     Section Layer:
@@ -31,107 +98,203 @@ def section_layer(
         previous_section_intent (Optional[str]): 直前の節の意図
         all_previous_sections (Optional[List[List[str]]]): これまでの全ての章の全ての節のリスト
         remaining_chapter_plots (Optional[List[str]]): まだ節に展開されていない章のプロットのリスト
+        on_section_plot (Optional[Callable[[str], Awaitable[None]]]): 指定した場合はレスポンスをストリーミングで受け取り、
+            節のプロットが確定した時点で（意図の生成完了を待たずに）この非同期関数を呼び出して待つ。
+            ストリームを読みながら呼ばれるので、ファイル書き込みなどのブロッキング処理はスレッドに逃がすこと。
+            上位のモデルで生成し直した場合は、生成し直したプロットで再度呼び出す
         
     Returns:
         Tuple[str, str]: 節のプロットと次の節に向けての意図
+        
+    Raises:
+        ValueError: 上位のモデルでもレスポンス形式が不正な場合
     """
     # セクションの生成準備
     current_section_index = 0 if not previous_sections else len(previous_sections)
     
     # 前のセクションの情報を生成
     previous_sections_info = ""
-    if previous_sections and len(previous_sections) > 0:
-        previous_sections_info = "# 現在の章における前のセクション\n"
-        for i, section in enumerate(previous_sections):
-            previous_sections_info += f"## セクション{i+1}\n{section}\n\n"
-    
-    # タイムライン情報を現在の章のみにフィルタリング
-    timeline_info = "# タイムライン情報\n"
-    if all_characters_timeline and len(all_characters_timeline) > 0:
-        # 最新のタイムラインを取得（現在の章までのタイムライン）
-        latest_timeline = all_characters_timeline[-1]
-        
-        for character, events in latest_timeline.items():
-            timeline_info += f"## {character}のタイムライン\n"
-            for date, event in events.items():
-                timeline_info += f"- {date}: {event}\n"
-            timeline_info += "\n"
+    if previous_sections:
+        previous_sections_info = "# 現在の章における前のセクション\n" + "".join(
+            f"## セクション{i+1}\n{section}\n\n" for i, section in enumerate(previous_sections)
+        )
+    
+    # タイムライン情報を現在の章のみにフィルタリング（最新のタイムライン = 現在の章までのタイムライン）し、
+    # さらに章のプロットに登場するキャラクターの直近の出来事に絞る
+    timeline_info = render_timeline_info(all_characters_timeline[-1] if all_characters_timeline else {}, chapter_plot)
 
     # 全ての過去のセクションとまだセクション化されていない章の情報を生成（新規）
-    all_content_info = ""
+    all_content_parts: List[str] = []
     
     # 1. 過去の章のセクション
-    if all_previous_sections and len(all_previous_sections) > 0:
-        all_content_info += "# これまでの章のセクション\n"
-        for chapter_idx, chapter_sections in enumerate(all_previous_sections):
-            all_content_info += f"## 第{chapter_idx+1}章\n"
-            for section_idx, section in enumerate(chapter_sections):
-                all_content_info += f"### セクション{section_idx+1}\n{section}\n\n"
+    # 章が進むほどプロンプトが伸び続けないよう、全文を含めるのはトークン予算に収まる直近の章だけにし、
+    # それより前の章は要約にとどめる
+    if all_previous_sections:
+        all_content_parts.append("# これまでの章のセクション\n")
+        chapter_blocks = [
+            f"## 第{chapter_idx+1}章\n" + "".join(
+                f"### セクション{section_idx+1}\n{section}\n\n" for section_idx, section in enumerate(chapter_sections)
+            )
+            for chapter_idx, chapter_sections in enumerate(all_previous_sections)
+        ]
+        recent_blocks = budget_pack(chapter_blocks, PREVIOUS_SECTIONS_TOKEN_BUDGET)
+        first_included_index = len(chapter_blocks) - len(recent_blocks)
+        
+        synopses = await asyncio.gather(
+            *(summarize_chapter_sections(chapter_sections) for chapter_sections in all_previous_sections[:first_included_index])
+        )
+        all_content_parts.extend(
+            f"## 第{chapter_idx+1}章（要約）\n{synopsis}\n\n" for chapter_idx, synopsis in enumerate(synopses)
+        )
+        all_content_parts.extend(recent_blocks)
     
     # 2. まだセクション化されていない章のプロット
-    if remaining_chapter_plots and len(remaining_chapter_plots) > 0:
-        all_content_info += "# 今後の章のプロット\n"
+    if remaining_chapter_plots:
+        all_content_parts.append("# 今後の章のプロット\n")
         start_idx = 0 if not all_previous_sections else len(all_previous_sections) + 1
-        for i, plot in enumerate(remaining_chapter_plots):
-            chapter_idx = start_idx + i
-            all_content_info += f"## 第{chapter_idx}章\n{plot}\n\n"
+        all_content_parts.extend(
+            f"## 第{chapter_idx}章\n{plot}\n\n" for chapter_idx, plot in enumerate(remaining_chapter_plots, start=start_idx)
+        )
+    all_content_info = "".join(all_content_parts)
     
     # プロンプトの構築
-    prompt = f"""
-    # セクション生成タスク
+    # 不変の物語設定はシステムプロンプトに、不変の指示はユーザープロンプトの先頭に置く。
+    # 以降は章の中で変わらない情報を先に、セクションごとに伸びる・変わる情報を末尾に並べ、
+    # 同じ章の後続セクションの呼び出しでもできるだけ長いプレフィックスが一致するようにする
+    system_prompt = build_story_context(master_plot, backstories, characters)
+    section_intent_block = f"[このセクションの意図]\n{previous_section_intent}" if previous_section_intent else ""
+    prompt = SECTION_PROMPT_INSTRUCTIONS + SECTION_PROMPT_TEMPLATE.format_map({
+        "chapter_plot": chapter_plot,
+        "timeline_info": timeline_info,
+        "all_content_info": all_content_info,
+        "previous_sections_info": previous_sections_info,
+        "section_intent_block": section_intent_block,
+        "section_number": current_section_index + 1,
+    })
     
-    あなたは物語の節（セクション）を生成するアシスタントです。「現在の章のプロット」を参考に、「現在の章における前のセクション」から物語が繋がるように、「このセクションの意図」を反映した詳細なセクションプロットを作成してください。セクションの意図の範囲内で物語を詳細化し、続きなどは書かないでください。
-
-    {f"[このセクションの意図]\n{previous_section_intent}" if previous_section_intent else ""}
+    # LLMを呼び出してセクションを生成（JSONモードを有効化）
+    # セクションはレイヤーの中で最も呼び出し回数が多いので、まず安価なモデルで生成し、
+    # 応答が不正な場合だけフラッグシップモデルで生成し直す。
+    # LLM_CACHE_GENERATIVE=1 の場合のみ、同じ入力での再実行（章の作り直しなど）では LLM を呼ばずにキャッシュから返す
+    try:
+        return await request_section(prompt, system_prompt, LLM_FAST_MODEL, on_section_plot)
+    except ValueError as e:
+        print(f"{LLM_FAST_MODEL} のセクション応答が不正なため、{LLM_MODEL} で生成し直します: {e}")
+    
+    return await request_section(prompt, system_prompt, LLM_MODEL, on_section_plot)
 
-    ## 入力情報:
+async def request_section(
+    prompt: str,
+    system_prompt: str,
+    model: str,
+    on_section_plot: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Tuple[str, str]:
+    """
+    指定したモデルでセクションを1回生成し、プロットと意図を抽出する。
     
-    # マスタープロット
-    {master_plot}
+    Args:
+        prompt (str): セクション生成のプロンプト
+        system_prompt (str): 物語設定のシステムプロンプト
+        model (str): 使用するモデル名
+        on_section_plot (Optional[Callable[[str], Awaitable[None]]]): section_layer と同じ
+        
+    Returns:
+        Tuple[str, str]: セクションプロットとセクション意図
+        
+    Raises:
+        ValueError: レスポンス形式が不正な場合
+    """
+    watcher = StreamingStringField("section_plot")
+    if on_section_plot is None:
+        response = await acall_llm(prompt, json_mode=True, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt, json_schema=SECTION_OUTPUT_SCHEMA, model=model)
+    else:
+        # プロットが閉じた時点で呼び出し側に渡し、意図の生成と後続処理を重ねる
+        chunks: List[str] = []
+        async for chunk in acall_llm_stream(prompt, json_mode=True, system_prompt=system_prompt, json_schema=SECTION_OUTPUT_SCHEMA, cache=LLM_CACHE_GENERATIVE, model=model):
+            chunks.append(chunk)
+            if (streamed_plot := watcher.feed(chunk)) is not None:
+                await on_section_plot(streamed_plot)
+        response = "".join(chunks)
     
-    # 世界観設定
-    {backstories}
+    # 最終的な応答からセクションプロットと意図を抽出
+    try:
+        section_plot, section_intent = extract_plot_and_intent(response)
+    except ValueError:
+        # 不正な応答をキャッシュに残すと再実行しても同じ失敗を繰り返すので削除する
+        evict_llm_cache(prompt, json_mode=True, system_prompt=system_prompt, json_schema=SECTION_OUTPUT_SCHEMA, model=model)
+        raise
     
-    # キャラクター設定
-    {characters}
+    # ストリーム中にプロットを検出できなかった場合は、ここで確定したプロットを渡す
+    if on_section_plot is not None and watcher.value is None:
+        await on_section_plot(section_plot)
     
-    # 現在の章のプロット
-    {chapter_plot}
+    return section_plot, section_intent
+
+# 章のセクションの要約。完成した章のセクションは変わらないので、一度要約すれば以降の全セクションで使い回せる
+_chapter_synopses: Dict[Tuple[str, ...], str] = {}
+
+async def summarize_chapter_sections(chapter_sections: List[str]) -> str:
+    """
+    完成した章のセクションを、安価なモデル（LLM_FAST_MODEL）で短いあらすじに要約する。
+    結果は章のセクションの内容をキーにメモリ上とディスクにキャッシュする。
     
-    {timeline_info}
+    Args:
+        chapter_sections (List[str]): 章の全てのセクションのプロット
+        
+    Returns:
+        str: 章のあらすじ
+    """
+    key = tuple(chapter_sections)
+    if (synopsis := _chapter_synopses.get(key)) is not None:
+        return synopsis
     
-    {previous_sections_info}
+    sections_text = "\n\n".join(chapter_sections)
+    try:
+        synopsis = await acall_llm(
+            CHAPTER_SYNOPSIS_PROMPT_INSTRUCTIONS + CHAPTER_SYNOPSIS_PROMPT_TEMPLATE.format_map({"sections_text": sections_text}),
+            cache=True,
+            model=LLM_FAST_MODEL,
+            temperature=0,
+            max_tokens=CHAPTER_SYNOPSIS_MAX_TOKENS,
+        )
+    except LLMCallError as e:
+        # 要約に失敗した場合は各セクションの冒頭の一文で代用する（次回は要約を再試行する）
+        print(f"章の要約に失敗したため、各セクションの冒頭の一文で代用します: {e}")
+        return "".join(section.strip().split("。", 1)[0] + "。" for section in chapter_sections)
     
-    {all_content_info}
+    _chapter_synopses[key] = synopsis
+    return synopsis
 
-    ## 指示
-    現在の章のプロットを元に、セクション{current_section_index + 1}のプロットを詳細に作成してください。
-    
-    1. このセクションで起こる主要な出来事、登場するキャラクター、彼らの行動、感情の変化などを詳細に含めてください。
-    2. 時系列、場所の描写、キャラクターの動きが明確になるように記述してください。
-    3. 現在の章のプロットの全体的なテーマを保ちながら、物語を進展させてください。
-    4. 前のセクションとの連続性を保ち、自然な流れを作りましょう。
-    
-    ## 出力形式
-    JSONフォーマットで以下の2つの部分を出力してください：
+# 直近に整形したタイムライン・章のプロットとその結果。
+# タイムラインと章のプロットは章ごとにしか変わらず、同じ章のセクションには同じオブジェクトが渡されるので、整形は章に一度で済む
+_last_rendered_timeline: Tuple[Optional[Dict[str, Any]], Optional[str], str] = (None, None, "")
 
-    {{
-        "section_plot": "詳細な物語の一部分としてのプロット。500-1000語程度。",
-        "section_intent": "次のセクションでどのように物語を展開したいかの簡潔な意図（100-200語程度）"
-    }}
+def render_timeline_info(latest_timeline: Dict[str, Any], chapter_plot: str) -> str:
     """
+    最新のタイムラインのうち、章のプロットに登場するキャラクターの直近の出来事をプロンプト用の箇条書きに整形する。
+    直前と同じオブジェクトが渡された場合は前回の結果を返す。
     
-    # LLMを呼び出してセクションを生成（JSONモードを有効化）
-    response = call_llm(prompt, json_mode=True)
-    
-    # 最終的な応答からセクションプロットと意図を抽出
-    section_plot, section_intent = extract_plot_and_intent(response)
+    Args:
+        latest_timeline (Dict[str, Any]): 現在の章までのキャラクタータイムライン
+        chapter_plot (str): 現在の章のプロット
+        
+    Returns:
+        str: 整形したタイムライン情報
+    """
+    global _last_rendered_timeline
+    rendered_timeline, rendered_chapter_plot, rendered_info = _last_rendered_timeline
+    if latest_timeline is rendered_timeline and chapter_plot is rendered_chapter_plot:
+        return rendered_info
     
-    # For debugging only - this will be removed in production
-    # save_section_to_mock_files(section_plot, section_intent, current_section_index)
+    timeline_parts: List[str] = ["# タイムライン情報\n"]
+    for character, events in select_relevant_timeline(latest_timeline, chapter_plot).items():
+        timeline_parts.append(f"## {character}のタイムライン\n")
+        timeline_parts.extend(f"- {date}: {event}\n" for date, event in events.items())
+        timeline_parts.append("\n")
+    timeline_info = "".join(timeline_parts)
     
-    return section_plot, section_intent
-
+    _last_rendered_timeline = (latest_timeline, chapter_plot, timeline_info)
+    return timeline_info
 
 def extract_plot_and_intent(response: str) -> Tuple[str, str]:
     """
@@ -142,59 +305,24 @@ def extract_plot_and_intent(response: str) -> Tuple[str, str]:
         
     Returns:
         Tuple[str, str]: セクションプロットとセクション意図
+        
+    Raises:
+        ValueError: JSONパースエラーやレスポンス形式が不正な場合
     """
     try:
-        # JSON形式のレスポンスをパース
-        data = json.loads(response)
-        
-        # キーからデータを取得
-        section_plot = data.get("section_plot", "")
-        section_intent = data.get("section_intent", "")
-        
-        # キーが存在しない、または値が空の場合はエラーを発生
-        if not section_plot:
-            pp.pprint(data)
-            raise ValueError("'section_plot' が見つからないか空です")
-        if not section_intent:
-            pp.pprint(data)
-            raise ValueError("'section_intent' が見つからないか空です")
-            
-    except json.JSONDecodeError as e:
-        # JSONパースに失敗した場合は例外を投げる
+        # JSONのパースとスキーマ検証を一度に行う（キーの欠落や文字列以外の値もここで検出する）
+        output = SectionOutput.model_validate_json(response)
+    except ValidationError as e:
+        # JSONパースやスキーマ検証に失敗した場合は例外を投げる
         raise ValueError(f"JSONパースに失敗しました: {e}\nレスポンス: {response[:100]}...")
     
+    section_plot = output.section_plot
+    section_intent = output.section_intent
+    
+    # 値が空の場合はエラーを発生
+    if not section_plot:
+        raise ValueError("'section_plot' が見つからないか空です")
+    if not section_intent:
+        raise ValueError("'section_intent' が見つからないか空です")
+    
     return section_plot, section_intent
-
-# Function to be removed as file saving will be centralized in main.py
-# def save_section_to_mock_files(section_plot: str, section_intent: str, section_index: int) -> None:
-#     """
-#     生成されたセクションプロットとインテントをモックファイルに保存する
-#     
-#     Args:
-#         section_plot (str): セクションプロット
-#         section_intent (str): セクション意図
-#         section_index (int): セクションのインデックス（0から始まる）
-#     """
-#     # セクションプロットを保存
-#     try:
-#         with open(f"section{section_index + 1}-plot-mock.txt", 'w', encoding='utf-8') as f:
-#             f.write(section_plot)
-#         print(f"セクション{section_index + 1}のプロットを section{section_index + 1}-plot-mock.txt に保存しました")
-#     except Exception as e:
-#         print(f"プロットファイルへの書き込み中にエラーが発生しました: {e}")
-#     
-#     # セクション意図を保存
-#     try:
-#         with open(f"section{section_index + 1}-intent-mock.txt", 'w', encoding='utf-8') as f:
-#             f.write(section_intent)
-#         print(f"セクション{section_index + 1}の意図を section{section_index + 1}-intent-mock.txt に保存しました")
-#     except Exception as e:
-#         print(f"意図ファイルへの書き込み中にエラーが発生しました: {e}")
-#     
-#     # セクション全体（プロットと意図を両方含む）を保存
-#     try:
-#         with open(f"section{section_index + 1}-mock.txt", 'w', encoding='utf-8') as f:
-#             f.write(f"# セクションプロット\n{section_plot}\n\n# セクション意図\n{section_intent}")
-#         print(f"セクション{section_index + 1}の全体を section{section_index + 1}-mock.txt に保存しました")
-#     except Exception as e:
-#         print(f"全体ファイルへの書き込み中にエラーが発生しました: {e}") 
@@ -1,9 +1,66 @@
 from typing import List, Dict, Any
+import re
 import json
-import os
-from utils import call_llm
+import orjson
+from utils import LLM_CACHE_GENERATIVE, acall_llm, build_story_context, count_tokens, evict_llm_cache
 
-def timeline_layer(
+# プロンプトに全章分のタイムラインをそのまま含める上限（トークン数）。超える場合は最新の累積タイムラインだけを含める
+PREVIOUS_TIMELINE_TOKEN_BUDGET = 2000
+
+# Section / Paragraph Layer のプロンプトに含める、関連するキャラクター1人あたりの直近の出来事の数
+RELEVANT_TIMELINE_EVENTS_PER_CHARACTER = 20
+
+# キャラクター名を姓・名などに分割する区切り文字
+_NAME_SEPARATOR = re.compile(r"[・･\s]+")
+
+# 章によらず不変の指示。ユーザープロンプトの先頭に置き、システムプロンプトと合わせてプレフィックスキャッシュに載せる
+TIMELINE_PROMPT_INSTRUCTIONS = """
+    # タイムライン生成タスク
+
+    あなたは物語のタイムラインを整理するアシスタントです。各キャラクターの行動や出来事を日時とともに記録し、JSONフォーマットで出力してください。
+
+    ## 出力形式
+    以下の形式のJSONを出力してください：
+
+    ```json
+    {
+      "キャラクター名A": {
+        "YYYY-MM-DD HH:MM": "出来事の説明",
+        "YYYY-MM-DD HH:MM": "出来事の説明"
+      },
+      "キャラクター名B": {
+        "YYYY-MM-DD HH:MM": "出来事の説明"
+      }
+    }
+    ```
+
+    注意事項：
+    1. 日付は「YYYY-MM-DD HH:MM」形式で記述してください（例: "2023-05-15 14:30"）
+    2. 指定したチャプターで新たに起きた出来事だけを出力してください。これまでのタイムラインにある出来事は繰り返さないでください（自動的に引き継がれます）
+    3. 事実のみを簡潔に記述し、解釈や感情は含めないでください
+    4. チャプター内の時系列が物語の時系列と一致しない場合があります
+    5. 必ず有効なJSONフォーマットで出力してください
+    6. 日時はこれまでのタイムラインと矛盾しないようにしてください
+
+    JSON形式のタイムラインのみを出力してください。他の説明は不要です。
+"""
+
+# 章ごとに変わる情報を埋め込むテンプレート。これまでのタイムラインを先に、この章のプロットと指示を末尾に置く
+# （出力形式の例に波括弧を含む TIMELINE_PROMPT_INSTRUCTIONS はテンプレートに含めず、連結する）
+TIMELINE_PROMPT_TEMPLATE = """
+    ## これまでのタイムライン
+    {previous_timeline}
+
+    ## 入力情報
+
+    [現在のチャプタープロット] (チャプター{chapter_number})
+    {chapter_plot}
+
+    ## 指示
+    チャプター{chapter_number}に含まれる各キャラクターの行動や重要な出来事をタイムライン形式で整理してください。
+    """
+
+async def timeline_layer(
     master_plot: str,
     backstories: str,
     characters: str,
@@ -18,9 +75,9 @@ def timeline_layer(
     処理の流れ：
     1. 現在処理中のチャプター番号を特定
     2. そのチャプターのプロットを取得
-    3. LLMにプロンプトを送信し、タイムラインを生成
-    4. JSONをパースし、前回のタイムラインに追加
-    5. 結果をモックファイルに保存（テスト用）
+    3. LLMにプロンプトを送信し、そのチャプターで新たに起きた出来事（差分）だけを生成
+    4. JSONをパースし、前回の累積タイムラインに差分をマージして、前回のタイムラインに追加
+       （previous_timeline をその場で更新する）
     
     各チャプターの後、タイムラインは「章数」の長さの配列となる。
     各インデックスには、そのチャプターまでの全キャラクターの累積タイムラインが含まれる。
@@ -55,10 +112,11 @@ def timeline_layer(
         backstories (str): 世界観の設定
         characters (str): キャラクターの設定
         chapter_plots (List[str]): これまでに生成された全チャプターのプロット
-        previous_timeline (List[Dict[str, Any]]): 前回までに生成されたタイムライン
+        previous_timeline (List[Dict[str, Any]]): 前回までに生成されたタイムライン。
+            今回のエントリが末尾に追加される（呼び出し側のリストが変更される）
         
     Returns:
-        List[Dict[str, Any]]: 更新されたタイムライン
+        List[Dict[str, Any]]: 更新されたタイムライン（previous_timeline と同じオブジェクト）
     """
     # 現在処理中のチャプター番号
     current_chapter_index = len(previous_timeline)
@@ -66,126 +124,145 @@ def timeline_layer(
     # 現在処理中のチャプターのプロット
     current_chapter_plot = chapter_plots[current_chapter_index]
     
-    # キャラクター名を抽出するための文字列を生成（プロンプト内で使用）
-    character_names = "キャラクター名を抽出できません"
-    try:
-        # 文字列からキャラクター名を抽出するロジックを実装
-        # 簡易的な実装としては、charactersからキャラクター名を抽出する
-        pass
-    except Exception as e:
-        print(f"キャラクター名の抽出中にエラーが発生しました: {e}")
+    # 物語設定は他のレイヤーと同じシステムプロンプトに置き、プレフィックスキャッシュを共有する
+    system_prompt = build_story_context(master_plot, backstories, characters)
     
     # プロンプトの構築
-    prompt = f"""
-    # タイムライン生成タスク
-
-    あなたは物語のタイムラインを整理するアシスタントです。各キャラクターの行動や出来事を日時とともに記録し、JSONフォーマットで出力してください。
-
-    ## 入力情報
-
-    [マスタープロット]
-    {master_plot}
-
-    [世界観設定]
-    {backstories}
-
-    [キャラクター設定]
-    {characters}
-
-    [現在のチャプタープロット] (チャプター{current_chapter_index + 1})
-    {current_chapter_plot}
-
-    ## これまでのタイムライン
-    {json.dumps(previous_timeline, ensure_ascii=False, indent=2) if previous_timeline else "まだタイムラインは生成されていません。"}
+    # これまでの出来事を毎章すべて書き直させると出力が章数に比例して伸びるので、
+    # この章の新しい出来事（差分）だけを出力させ、累積タイムラインへのマージは Python 側で行う。
+    # 不変の指示を先頭に、章ごとに変わるタイムラインとプロットを後ろに置いて、プレフィックスキャッシュを効かせる
+    prompt = TIMELINE_PROMPT_INSTRUCTIONS + TIMELINE_PROMPT_TEMPLATE.format_map({
+        "previous_timeline": format_previous_timeline(previous_timeline),
+        "chapter_number": current_chapter_index + 1,
+        "chapter_plot": current_chapter_plot,
+    })
+    
+    # LLMを呼び出してタイムラインの差分を生成
+    # LLM_CACHE_GENERATIVE=1 の場合のみ、同じ入力での再実行では LLM を呼ばずにキャッシュから返す
+    response = await acall_llm(prompt, cache=LLM_CACHE_GENERATIVE, system_prompt=system_prompt)
+    
+    # レスポンスからJSONを抽出してパース
+    try:
+        timeline_delta = parse_json_from_response(response)
+    except ValueError as e:
+        print(f"JSONデコードに失敗しました: {e}")
+        print(f"受け取った文字列: {response}")
+        # 不正な応答をキャッシュに残さない
+        evict_llm_cache(prompt, system_prompt=system_prompt)
+        # エラー時は差分なしとして、前回までのタイムラインを引き継ぐ
+        timeline_delta = {}
+    
+    new_timeline_entry = merge_timeline_delta(previous_timeline[-1] if previous_timeline else {}, timeline_delta)
+    
+    # 前回のタイムラインに今回のエントリを追加（章ごとにリスト全体をコピーしないよう、その場で追加する）
+    previous_timeline.append(new_timeline_entry)
+    
+    return previous_timeline
 
-    ## 指示
-    チャプター{current_chapter_index + 1}に含まれる各キャラクターの行動や重要な出来事をタイムライン形式で整理してください。
-    以下の形式のJSONを出力してください：
 
-    ```json
-    {{
-      "キャラクター名A": {{
-        "YYYY-MM-DD HH:MM": "出来事の説明",
-        "YYYY-MM-DD HH:MM": "出来事の説明"
-      }},
-      "キャラクター名B": {{
-        "YYYY-MM-DD HH:MM": "出来事の説明"
-      }}
-    }}
-    ```
+def merge_timeline_delta(latest_timeline: Dict[str, Any], timeline_delta: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    前回までの累積タイムラインに、章で新たに起きた出来事をマージした新しい累積タイムラインを作る。
+    前回の累積タイムラインは変更しない（各章のエントリはそれぞれ独立した辞書になる）。
+    
+    Args:
+        latest_timeline (Dict[str, Any]): 前回までの累積タイムライン
+        timeline_delta (Dict[str, Any]): 章で新たに起きた出来事（キャラクター名 -> {日時: 出来事}）
+        
+    Returns:
+        Dict[str, Any]: 今回の章までの累積タイムライン
+    """
+    merged = {character: dict(events) for character, events in latest_timeline.items()}
+    for character, events in timeline_delta.items():
+        if isinstance(events, dict):
+            merged.setdefault(character, {}).update(events)
+    return merged
 
-    注意事項：
-    1. 日付は「YYYY-MM-DD HH:MM」形式で記述してください（例: "2023-05-15 14:30"）
-    2. 同じキャラクターの以前のタイムラインエントリも保持し、チャプター{current_chapter_index + 1}での新しい出来事を追加してください
-    3. 事実のみを簡潔に記述し、解釈や感情は含めないでください
-    4. チャプター内の時系列が物語の時系列と一致しない場合があります
-    5. 必ず有効なJSONフォーマットで出力してください
-    6. すべてのキャラクターのタイムラインを含めてください（たとえチャプター{current_chapter_index + 1}に登場しなくても）
 
-    JSON形式のタイムラインのみを出力してください。他の説明は不要です。
+def format_previous_timeline(previous_timeline: List[Dict[str, Any]]) -> str:
     """
+    これまでのタイムラインをプロンプト用の JSON 文字列にする。
+    各要素はその章までの累積タイムラインなので、大きすぎる場合は最新の要素だけで情報は足りる。
+    最新の要素を先にシリアライズし、全体が上限に収まると見込める場合だけ全体をシリアライズする
+    （累積なので各要素は最新の要素以下の大きさであり、全体は「最新の要素のトークン数 × 章数」を概ね超えない）。
+    トークン数は count_tokens のキャッシュが効くので、同じ章のタイムラインを数え直すことはない。
     
-    # LLMを呼び出してタイムラインを生成
-    response = call_llm(prompt)
-    
-    # JSONの抽出（レスポンスからJSONのみを抽出する処理）
-    json_str = extract_json_from_response(response)
-    
-    # JSON文字列をパース
-    try:
-        new_timeline_entry = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        print(f"JSONデコードに失敗しました: {e}")
-        print(f"受け取った文字列: {json_str}")
-        # エラー時は空の辞書を返す
-        new_timeline_entry = {}
+    Args:
+        previous_timeline (List[Dict[str, Any]]): 前回までに生成されたタイムライン
+        
+    Returns:
+        str: プロンプトに埋め込むタイムライン
+    """
+    if not previous_timeline:
+        return "まだタイムラインは生成されていません。"
     
-    # 前回のタイムラインに今回のエントリを追加
-    updated_timeline = previous_timeline.copy()
-    updated_timeline.append(new_timeline_entry)
+    latest_json = orjson.dumps(previous_timeline[-1]).decode()
+    if len(previous_timeline) == 1 or count_tokens(latest_json) * len(previous_timeline) > PREVIOUS_TIMELINE_TOKEN_BUDGET:
+        return latest_json
+    return orjson.dumps(previous_timeline).decode()
+
+def select_relevant_timeline(
+    latest_timeline: Dict[str, Any],
+    text: str,
+    max_events_per_character: int = RELEVANT_TIMELINE_EVENTS_PER_CHARACTER
+) -> Dict[str, Any]:
+    """
+    累積タイムラインから、text に登場するキャラクターの直近の出来事だけを取り出す。
+    物語が進むほど伸びるタイムライン全体ではなく、これから書く部分に関係する分だけをプロンプトに含めるために使う。
+    キャラクター名は全体のほか、「・」や空白で区切った各部分（2文字以上）でも照合する。
+    該当するキャラクターがいない場合は、全キャラクターの直近の出来事を返す。
     
-    # For debugging only - will be removed in production
-    # save_timeline_to_mock_files(updated_timeline, current_chapter_index)
+    Args:
+        latest_timeline (Dict[str, Any]): 現在の章までの累積タイムライン
+        text (str): これから生成する部分のプロット（章やセクションのプロット）
+        max_events_per_character (int): キャラクターごとに残す直近の出来事の数
+        
+    Returns:
+        Dict[str, Any]: 絞り込んだタイムライン（latest_timeline と同じ形式）
+    """
+    def is_mentioned(character: str) -> bool:
+        return character in text or any(
+            len(part) >= 2 and part in text for part in _NAME_SEPARATOR.split(character)
+        )
     
-    return updated_timeline
+    relevant_characters = [character for character in latest_timeline if is_mentioned(character)] or list(latest_timeline)
+    relevant_timeline: Dict[str, Any] = {}
+    for character in relevant_characters:
+        events = latest_timeline[character]
+        if isinstance(events, dict) and len(events) > max_events_per_character:
+            events = dict(list(events.items())[-max_events_per_character:])
+        relevant_timeline[character] = events
+    return relevant_timeline
 
+# raw_decode で文字列の途中から JSON を1つだけ読み取るためのデコーダー
+_JSON_DECODER = json.JSONDecoder()
 
-def extract_json_from_response(response: str) -> str:
+def parse_json_from_response(response: str) -> Dict[str, Any]:
     """
-    LLMのレスポンスからJSON部分のみを抽出する
+    LLMのレスポンスから JSON オブジェクトを取り出してパースする
     
-    このヘルパー関数は以下の順序でJSONを抽出しようとします:
-    1. ```json```で囲まれたコードブロック内のJSONを探す
-    2. レスポンス全体が有効なJSONかどうかチェック
-    3. 最初の { から最後の } までを抽出し、有効なJSONとして解析する
+    ```json``` のコードブロックがあればその中の、なければレスポンス中の最初の { から
+    JSON オブジェクトを1つだけ読み取る。抽出とパースを一度の走査で行い、
+    文字列中に } が含まれていても正しく終端を判定できる。
     
     Args:
         response (str): LLMからのレスポンス
         
     Returns:
-        str: 抽出されたJSON文字列
+        Dict[str, Any]: パースした JSON オブジェクト
+        
+    Raises:
+        ValueError: JSON オブジェクトが見つからないか、パースに失敗した場合
     """
-    # JSONのコードブロックを探す
-    json_pattern_start = "```json"
-    json_pattern_end = "```"
-    
-    if json_pattern_start in response:
-        start_index = response.find(json_pattern_start) + len(json_pattern_start)
-        end_index = response.find(json_pattern_end, start_index)
-        if end_index > start_index:
-            json_str = response[start_index:end_index].strip()
-            return json_str
-    
-    # コードブロックがない場合は、レスポンス全体からJSONを抽出しようとする
-    # { で始まり } で終わる部分を探す
-    if response.strip().startswith("{") and response.strip().endswith("}"):
-        return response.strip()
-    
-    # 上記の方法で抽出できない場合は、最初の { から最後の } までを抽出
-    start_index = response.find("{")
-    end_index = response.rfind("}")
-    if start_index != -1 and end_index > start_index:
-        return response[start_index:end_index+1]
-    
-    # どの方法でも抽出できない場合は、エラーメッセージ付きの空のJSONを返す
-    return '{}'
+    fence_index = response.find("```json")
+    search_from = fence_index + len("```json") if fence_index != -1 else 0
+    
+    start_index = response.find("{", search_from)
+    if start_index == -1:
+        raise ValueError("レスポンスに JSON オブジェクトが見つかりません")
+    
+    # JSONDecodeError は ValueError のサブクラス
+    parsed, _ = _JSON_DECODER.raw_decode(response, start_index)
+    if not isinstance(parsed, dict):
+        raise ValueError("JSON オブジェクトではありません")
+    return parsed
@@ -1,17 +1,14 @@
 import os
 import sys
-import time
+import logging
+import asyncio
 import argparse
-from dotenv import load_dotenv
-from langchain_openai import OpenAI
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import CommaSeparatedListOutputParser
-from langchain.chains import LLMChain
-import json
-import shutil
-from typing import Tuple, List, Dict, Any, Optional, Union, TypedDict, cast, Literal
+import orjson
+from typing import List, Deque, Dict, Any, Optional, Set, TextIO, Awaitable, TypedDict
 from pathlib import Path
-from enum import Enum, auto
+from enum import Enum
+from functools import lru_cache, partial
+from collections import deque
 
 from layers import (
     plot_layer,
@@ -20,14 +17,24 @@ from layers import (
     chapter_layer,
     timeline_layer,
     section_layer,
-    paragraph_layer
+    paragraph_layer,
+    select_relevant_timeline,
+    summarize_previous_paragraphs,
+    PREVIOUS_PARAGRAPHS_MAX_COUNT
 )
 from filters import (
     backstory_consistency_validation_filter,
     chapter_level_causal_chain_validation_filter,
     section_level_causal_chain_validation_filter,
-    style_filter
+    style_filter,
+    section_style_filter,
+    build_backstory_consistency_validation_filter_prompt,
+    build_chapter_level_causal_chain_validation_filter_prompt,
+    build_section_level_causal_chain_validation_filter_prompt,
+    build_style_filter_prompt,
+    STYLE_FILTER_MODEL
 )
+from utils import LLMCallError, aclose_llm_clients, batch_llm, build_batch_job, llm_cache_summary, prompt_cache_summary
 
 # 利用可能なレイヤーを定義するEnum
 class Layer(Enum):
@@ -56,6 +63,16 @@ class Timeline(TypedDict):
 # 出力ディレクトリ設定
 OUTPUT_DIR = Path("./output")
 
+# 1章あたりのデフォルトのセクション数
+DEFAULT_SECTION_COUNT = 3
+
+# 作成済みのディレクトリ（同じディレクトリに mkdir を繰り返さないため）
+_DIRS_CREATED: Set[Path] = set()
+
+# バッチモードで、章内の段落数がこれを超える場合のみスタイルフィルターを Batch API に回す
+# （それ以下ならセクションごとに1リクエストへまとめて並列に実行する方が早く終わる）
+STYLE_BATCH_THRESHOLD = 8
+
 class Colors:
     HEADER = '\033[95m'
     BLUE = '\033[94m'
@@ -67,35 +84,151 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+# print_status のレベル名と logging のレベルの対応（success は INFO と WARNING の間に独自のレベルを割り当てる）
+SUCCESS = 25
+logging.addLevelName(SUCCESS, "SUCCESS")
+STATUS_LEVELS: Dict[str, int] = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "success": SUCCESS,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "header": logging.INFO,
+}
+
+logger = logging.getLogger("story_gen")
+
+class ColorFormatter(logging.Formatter):
+    """
+    print_status のレベルごとに色分けして表示するフォーマッター。
+    時刻の整形は出力されるレコードに対してだけ行われる
+    """
+    LEVEL_COLORS = {
+        "debug": Colors.CYAN,
+        "info": Colors.BLUE,
+        "success": Colors.GREEN,
+        "warning": Colors.YELLOW,
+        "error": Colors.RED,
+    }
+    
+    def __init__(self) -> None:
+        super().__init__(datefmt="%H:%M:%S")
+    
+    def format(self, record: logging.LogRecord) -> str:
+        prefix = f"[{self.formatTime(record, self.datefmt)}]"
+        status_level = getattr(record, "status_level", record.levelname.lower())
+        message = record.getMessage()
+        if status_level == "header":
+            return f"\n{Colors.HEADER}{Colors.BOLD}{prefix} {message}{Colors.ENDC}"
+        color = self.LEVEL_COLORS.get(status_level)
+        if color is None:
+            return f"{prefix} {message}"
+        return f"{color}{prefix} {status_level.upper()}:{Colors.ENDC} {message}"
+
+def setup_logging(verbose: bool = False) -> None:
+    """
+    コンソールへのログ出力を一度だけ設定する
+    
+    Args:
+        verbose (bool): ファイルの読み書きなどの DEBUG メッセージも表示するかどうか
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(ColorFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
 def print_status(message: str, level: str = "info") -> None:
     """
     Print a status message with color coding
     
     Args:
         message (str): Message to print
-        level (str): Message level (info, success, warning, error, header)
-    """
-    now = time.strftime("%H:%M:%S")
-    prefix = f"[{now}]"
-    
-    if level == "info":
-        print(f"{Colors.BLUE}{prefix} INFO:{Colors.ENDC} {message}")
-    elif level == "success":
-        print(f"{Colors.GREEN}{prefix} SUCCESS:{Colors.ENDC} {message}")
-    elif level == "warning":
-        print(f"{Colors.YELLOW}{prefix} WARNING:{Colors.ENDC} {message}")
-    elif level == "error":
-        print(f"{Colors.RED}{prefix} ERROR:{Colors.ENDC} {message}")
-    elif level == "header":
-        print(f"\n{Colors.HEADER}{Colors.BOLD}{prefix} {message}{Colors.ENDC}")
+        level (str): Message level (debug, info, success, warning, error, header)
+    """
+    logger.log(STATUS_LEVELS.get(level, logging.INFO), message, extra={"status_level": level})
+
+def print_validation_result(subject: str, validation: str) -> None:
+    """
+    バリデーションフィルターの結果を表示する
+    
+    Args:
+        subject (str): 検証対象の説明（例: "Chapter 1"）
+        validation (str): バリデーションフィルターの出力
+    """
+    if "OK" not in validation:
+        print_status(f"{subject} validation failed: {validation}", "warning")
     else:
-        print(f"{prefix} {message}")
+        print_status(f"{subject} validation passed", "success")
 
 def ensure_dir(directory: Path) -> None:
     """
     Ensure a directory exists, creating it if necessary
     """
+    if directory in _DIRS_CREATED:
+        return
     directory.mkdir(parents=True, exist_ok=True)
+    _DIRS_CREATED.add(directory)
+
+def scan_dir(directory: Path) -> List["os.DirEntry[str]"]:
+    """
+    ディレクトリのエントリを列挙する。
+    os.scandir の DirEntry はファイル種別を列挙時に取得済みなので、エントリごとに stat を発行しない
+    
+    Args:
+        directory (Path): 列挙するディレクトリ
+        
+    Returns:
+        List[os.DirEntry[str]]: ディレクトリのエントリ（ディレクトリが存在しない場合は空）
+    """
+    try:
+        with os.scandir(directory) as it:
+            return list(it)
+    except FileNotFoundError:
+        return []
+
+@lru_cache(maxsize=None)
+def chapter_output_dir(chapter_index: int) -> Path:
+    """
+    章の出力ディレクトリのパスを返す。
+    章のファイルを読み書きするたびにパスを組み立て直さないよう、章ごとに一度だけ生成する
+    
+    Args:
+        chapter_index (int): 章のインデックス（0始まり）
+        
+    Returns:
+        Path: 章の出力ディレクトリ
+    """
+    return OUTPUT_DIR / f"chapters/{chapter_index+1:02d}"
+
+@lru_cache(maxsize=None)
+def section_output_dir(chapter_index: int, section_index: int) -> Path:
+    """
+    セクションの出力ディレクトリのパスを返す（セクションごとに一度だけ生成する）
+    
+    Args:
+        chapter_index (int): 章のインデックス（0始まり）
+        section_index (int): セクションのインデックス（0始まり）
+        
+    Returns:
+        Path: セクションの出力ディレクトリ
+    """
+    return chapter_output_dir(chapter_index) / f"sec_{section_index+1:02d}"
+
+def prepare_output_dirs(chapter_count: int, section_count: int = DEFAULT_SECTION_COUNT) -> None:
+    """
+    出力先のディレクトリツリー（章・セクション）を生成開始前に一度だけ作成する。
+    以降のファイル書き込みではディレクトリの存在確認を行わない
+    
+    Args:
+        chapter_count (int): 生成する章の数
+        section_count (int): 1章あたりのセクション数
+    """
+    ensure_dir(OUTPUT_DIR)
+    for ch_i in range(chapter_count):
+        for sec_i in range(section_count):
+            ensure_dir(section_output_dir(ch_i, sec_i))
 
 def save_to_file(content: str, file_path: Path) -> None:
     """
@@ -106,9 +239,8 @@ def save_to_file(content: str, file_path: Path) -> None:
         file_path (Path): Path to save the file to
     """
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        print_status(f"Saved content to {file_path}", "success")
+        file_path.write_text(content, encoding='utf-8')
+        print_status(f"Saved content to {file_path}", "debug")
     except Exception as e:
         print_status(f"Error saving to {file_path}: {e}", "error")
 
@@ -122,18 +254,50 @@ def read_from_file(file_path: Path) -> Optional[str]:
     Returns:
         Optional[str]: File content or None if file doesn't exist
     """
-    if not file_path.exists():
-        return None
-    
+    # 存在確認を別に行わず、読み込みの失敗で判定する（stat を1回減らす）
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        print_status(f"Read content from {file_path}", "success")
+        content = file_path.read_text(encoding='utf-8')
+        print_status(f"Read content from {file_path}", "debug")
         return content
+    except FileNotFoundError:
+        return None
     except Exception as e:
         print_status(f"Error reading from {file_path}: {e}", "error")
         return None
 
+async def asave_to_file(content: str, file_path: Path) -> None:
+    """
+    save_to_file の非同期版。書き込みはスレッドで行い、イベントループ上の LLM 呼び出しを止めない
+    
+    Args:
+        content (str): Text content to save
+        file_path (Path): Path to save the file to
+    """
+    await asyncio.to_thread(save_to_file, content, file_path)
+
+async def aread_from_file(file_path: Path) -> Optional[str]:
+    """
+    read_from_file の非同期版。読み込みはスレッドで行い、イベントループ上の LLM 呼び出しを止めない
+    
+    Args:
+        file_path (Path): Path to read from
+    
+    Returns:
+        Optional[str]: File content or None if file doesn't exist
+    """
+    return await asyncio.to_thread(read_from_file, file_path)
+
+def write_story_parts(story_file: TextIO, parts: List[str]) -> None:
+    """
+    開いているファイルに本文の断片を書き込み、すぐにディスクへ反映する
+    
+    Args:
+        story_file (TextIO): 書き込み先のファイル
+        parts (List[str]): 書き込む本文の断片
+    """
+    story_file.writelines(parts)
+    story_file.flush()
+
 def save_timeline_to_file(timeline: List[Dict[str, Any]], chapter_index: int) -> None:
     """
     Save timeline data to a JSON file
@@ -142,14 +306,12 @@ def save_timeline_to_file(timeline: List[Dict[str, Any]], chapter_index: int) ->
         timeline (List[Dict[str, Any]]): Timeline data to save
         chapter_index (int): Current chapter index
     """
-    chapter_dir = OUTPUT_DIR / f"chapters/{chapter_index+1:02d}"
-    ensure_dir(chapter_dir)
-    
-    timeline_file = chapter_dir / "_timeline.txt"
+    timeline_file = chapter_output_dir(chapter_index) / "_timeline.txt"
     try:
-        with open(timeline_file, 'w', encoding='utf-8') as f:
-            json.dump(timeline[chapter_index] if chapter_index < len(timeline) else {}, f, ensure_ascii=False, indent=2)
-        print_status(f"Timeline saved to {timeline_file}", "success")
+        # orjson は UTF-8 のバイト列を直接返すので、バイナリモードでそのまま書き込む
+        with open(timeline_file, 'wb') as f:
+            f.write(orjson.dumps(timeline[chapter_index] if chapter_index < len(timeline) else {}, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        print_status(f"Timeline saved to {timeline_file}", "debug")
     except Exception as e:
         print_status(f"Error saving timeline to {timeline_file}: {e}", "error")
 
@@ -157,7 +319,7 @@ class StoryGenerator:
     """
     物語生成を管理するクラス
     """
-    def __init__(self, user_input: str, chapter_count: int = 5, resume: bool = False):
+    def __init__(self, user_input: str, chapter_count: int = 5, resume: bool = False, batch_mode: bool = False, persist: bool = True, style_batch: bool = False):
         """
         StoryGenerator を初期化する
         
@@ -165,10 +327,18 @@ class StoryGenerator:
             user_input (str): ユーザーからの初期プロンプト
             chapter_count (int): 生成する章の数
             resume (bool): 既存ファイルから再開するかどうか
+            batch_mode (bool): バリデーション・スタイルフィルターを Batch API でまとめて実行するかどうか
+            persist (bool): 途中の生成物（各レイヤーの出力）をファイルに保存するかどうか。
+                False の場合は完全なストーリーだけを保存する（後から再開はできない）
+            style_batch (bool): スタイルフィルターだけを Batch API でまとめて実行するかどうか
+                （バリデーションは通常どおり逐次実行する。batch_mode の場合は常に有効）
         """
         self.user_input = user_input
         self.chapter_count = chapter_count
         self.resume = resume
+        self.batch_mode = batch_mode
+        self.persist = persist
+        self.style_batch = style_batch or batch_mode
         
         # 各レイヤーの結果を保存する変数
         self.master_plot: str = ""  # None から空文字列に変更
@@ -177,12 +347,17 @@ class StoryGenerator:
         self.chapter_plots: List[str] = []
         self.chapter_intents: List[str] = []
         self.all_characters_timeline: List[Dict[str, Any]] = []
+        # バリデーションフィルターに渡す全タイムラインの JSON（タイムライン更新時に一度だけシリアライズする）
+        self.timeline_json: str = "[]"
         self.section_plots: List[List[str]] = []
         self.section_intents: List[List[str]] = []
         self.story_text: str = ""
         
-        # 出力ディレクトリを初期化
-        ensure_dir(OUTPUT_DIR)
+        # 出力ディレクトリツリーを初期化（書き込みのたびに作成しないよう、ここでまとめて作る）
+        if persist:
+            prepare_output_dirs(chapter_count)
+        else:
+            ensure_dir(OUTPUT_DIR)
         
         # 開始メッセージを表示
         if resume:
@@ -192,7 +367,18 @@ class StoryGenerator:
             print_status("Story generation started in NEW mode", "header")
             print_status("Creating a new story from scratch", "info")
 
-    def generate_plot(self) -> str:
+    async def save_artifact(self, content: str, file_path: Path) -> None:
+        """
+        途中の生成物をファイルに保存する（persist が False の場合は何もしない）
+        
+        Args:
+            content (str): Text content to save
+            file_path (Path): Path to save the file to
+        """
+        if self.persist:
+            await asave_to_file(content, file_path)
+
+    async def generate_plot(self) -> str:
         """
         マスタープロットを生成する
         
@@ -201,17 +387,17 @@ class StoryGenerator:
         """
         print_status("=== PLOT LAYER ===", "header")
         master_plot_path = OUTPUT_DIR / "master_plot.txt"
-        if self.resume and (cached_master_plot := read_from_file(master_plot_path)) is not None:
+        if self.resume and (cached_master_plot := await aread_from_file(master_plot_path)) is not None:
             print_status("Resuming with existing master plot", "success")
             self.master_plot = cached_master_plot
         else:
             print_status("Generating new master plot...", "info")
-            self.master_plot = plot_layer(self.user_input)
-            save_to_file(self.master_plot, master_plot_path)
+            self.master_plot = await plot_layer(self.user_input)
+            await self.save_artifact(self.master_plot, master_plot_path)
         
         return self.master_plot
     
-    def generate_backstory(self) -> str:
+    async def generate_backstory(self) -> str:
         """
         世界観設定を生成する
         
@@ -219,21 +405,21 @@ class StoryGenerator:
             str: 生成された世界観設定
         """
         if not self.master_plot:  # 空文字列のチェックに変更
-            self.generate_plot()
+            await self.generate_plot()
         
         print_status("=== BACKSTORY LAYER ===", "header")
         backstories_path = OUTPUT_DIR / "backstory.txt"
-        if self.resume and (cached_backstories := read_from_file(backstories_path)) is not None:
+        if self.resume and (cached_backstories := await aread_from_file(backstories_path)) is not None:
             print_status("Resuming with existing backstories", "success")
             self.backstories = cached_backstories
         else:
             print_status("Generating new backstories...", "info")
-            self.backstories = backstory_layer(self.master_plot)
-            save_to_file(self.backstories, backstories_path)
+            self.backstories = await backstory_layer(self.master_plot)
+            await self.save_artifact(self.backstories, backstories_path)
         
         return self.backstories
     
-    def generate_characters(self) -> str:
+    async def generate_characters(self) -> str:
         """
         キャラクター設定を生成する
         
@@ -241,21 +427,21 @@ class StoryGenerator:
             str: 生成されたキャラクター設定
         """
         if not self.backstories:  # 空文字列のチェックに変更
-            self.generate_backstory()
+            await self.generate_backstory()
         
         print_status("=== CHARACTER LAYER ===", "header")
         characters_path = OUTPUT_DIR / "character.txt"
-        if self.resume and (cached_characters := read_from_file(characters_path)) is not None:
+        if self.resume and (cached_characters := await aread_from_file(characters_path)) is not None:
             print_status("Resuming with existing characters", "success")
             self.characters = cached_characters
         else:
             print_status("Generating new characters...", "info")
-            self.characters = character_layer(self.master_plot, self.backstories)
-            save_to_file(self.characters, characters_path)
+            self.characters = await character_layer(self.master_plot, self.backstories)
+            await self.save_artifact(self.characters, characters_path)
         
         return self.characters
     
-    def generate_chapters(self) -> List[str]:
+    async def generate_chapters(self) -> List[str]:
         """
         章ごとのプロットを生成する
         
@@ -263,69 +449,124 @@ class StoryGenerator:
             List[str]: 生成された章のプロットのリスト
         """
         if not self.characters:  # 空文字列のチェックに変更
-            self.generate_characters()
+            await self.generate_characters()
         
         print_status("=== CHAPTER LAYER ===", "header")
         
-        for ch_i in range(self.chapter_count):
-            print_status(f"Processing Chapter {ch_i+1}/{self.chapter_count}", "header")
-            chapter_dir = OUTPUT_DIR / f"chapters/{ch_i+1:02d}"
-            ensure_dir(chapter_dir)
+        # 直前の章までのタイムライン生成タスク（次の章のプロット生成と並行して進める）
+        timeline_task: Optional["asyncio.Task[None]"] = None
+        # 章ごとの整合性チェックのタスク（章の順）
+        chapter_validation_tasks: List["asyncio.Task[str]"] = []
+        
+        try:
+            for ch_i in range(self.chapter_count):
+                print_status(f"Processing Chapter {ch_i+1}/{self.chapter_count}", "header")
+                chapter_dir = chapter_output_dir(ch_i)
+                
+                # 章ファイルが既に存在するかチェック
+                chapter_plot_path = chapter_dir / "_plot.txt"
+                chapter_intent_path = chapter_dir / "_intent.txt"
+                
+                if self.resume and (cached_chapter_plot := await aread_from_file(chapter_plot_path)) is not None and (cached_chapter_intent := await aread_from_file(chapter_intent_path)) is not None:
+                    print_status(f"Resuming with existing Chapter {ch_i+1}", "success")
+                    chapter_plot = cached_chapter_plot
+                    chapter_intent = cached_chapter_intent
+                else:
+                    print_status(f"Generating new Chapter {ch_i+1}...", "info")
+                    is_final_chapter = (ch_i == self.chapter_count - 1)
+                    chapter_plot, chapter_intent = await chapter_layer(
+                        self.master_plot,
+                        self.backstories,
+                        self.characters,
+                        ch_i,
+                        previous_chapter_plots=self.chapter_plots if self.chapter_plots else None,
+                        previous_chapter_intents=self.chapter_intents if self.chapter_intents else None,
+                        is_final_chapter=is_final_chapter
+                    )
+                    await asyncio.gather(
+                        self.save_artifact(chapter_plot, chapter_plot_path),
+                        self.save_artifact(chapter_intent, chapter_intent_path),
+                    )
+                
+                self.chapter_plots.append(chapter_plot)
+                self.chapter_intents.append(chapter_intent)
+                
+                # タイムラインレイヤーの生成は各章ごとに必要。
+                # 次の章のプロット生成やこの章の検証はタイムラインを使わないので、完了を待たずに進める
+                timeline_task = asyncio.create_task(self.generate_timeline_after(timeline_task, ch_i))
+                
+                # 章を検証（バッチモードでは全章分を最後にまとめて検証する）
+                # 検証結果は次の章の生成に使わないので、タイムライン生成や次の章のプロット生成と並行して進める
+                if not self.batch_mode:
+                    print_status(f"=== VALIDATING CHAPTER {ch_i+1} ===", "header")
+                    chapter_validation_tasks.append(asyncio.create_task(backstory_consistency_validation_filter(
+                        self.master_plot, self.backstories, self.characters, 
+                        chapter_plot, chapter_intent
+                    )))
             
-            # 章ファイルが既に存在するかチェック
-            chapter_plot_path = chapter_dir / "_plot.txt"
-            chapter_intent_path = chapter_dir / "_intent.txt"
+            # 全体の因果チェックは全章のタイムラインを使うので、ここで生成の完了を待つ
+            if timeline_task is not None:
+                await timeline_task
             
-            if self.resume and (cached_chapter_plot := read_from_file(chapter_plot_path)) is not None and (cached_chapter_intent := read_from_file(chapter_intent_path)) is not None:
-                print_status(f"Resuming with existing Chapter {ch_i+1}", "success")
-                chapter_plot = cached_chapter_plot
-                chapter_intent = cached_chapter_intent
-            else:
-                print_status(f"Generating new Chapter {ch_i+1}...", "info")
-                is_final_chapter = (ch_i == self.chapter_count - 1)
-                chapter_plot, chapter_intent = chapter_layer(
-                    self.master_plot,
-                    self.backstories,
-                    self.characters,
-                    ch_i,
-                    previous_chapter_plots=self.chapter_plots if self.chapter_plots else None,
-                    previous_chapter_intents=self.chapter_intents if self.chapter_intents else None,
-                    is_final_chapter=is_final_chapter
+            # すべての章を検証
+            print_status("=== VALIDATING ALL CHAPTERS ===", "header")
+            chapter_plots_json = orjson.dumps(self.chapter_plots).decode()
+            if self.batch_mode:
+                # 章ごとの整合性チェックと全体の因果チェックを1つのバッチにまとめる
+                jobs: List[Dict[str, Any]] = []
+                for ch_i, (chapter_plot, chapter_intent) in enumerate(zip(self.chapter_plots, self.chapter_intents)):
+                    system_prompt, prompt = build_backstory_consistency_validation_filter_prompt(
+                        self.master_plot, self.backstories, self.characters,
+                        chapter_plot, chapter_intent
+                    )
+                    jobs.append(build_batch_job(f"bcvf:{ch_i+1:02d}", prompt, system_prompt=system_prompt))
+                system_prompt, prompt = build_chapter_level_causal_chain_validation_filter_prompt(
+                    self.master_plot, self.backstories, self.timeline_json,
+                    self.characters, chapter_plots_json
                 )
-                save_to_file(chapter_plot, chapter_plot_path)
-                save_to_file(chapter_intent, chapter_intent_path)
-            
-            self.chapter_plots.append(chapter_plot)
-            self.chapter_intents.append(chapter_intent)
-            
-            # タイムラインレイヤーの生成は各章ごとに必要
-            self.generate_timeline_for_chapter(ch_i)
-            
-            # 章を検証
-            print_status(f"=== VALIDATING CHAPTER {ch_i+1} ===", "header")
-            validation: str = backstory_consistency_validation_filter(
-                self.master_plot, self.backstories, self.characters, 
-                chapter_plot, chapter_intent
-            )
-            if "OK" not in validation:
-                print_status(f"Chapter {ch_i+1} validation failed: {validation}", "warning")
+                jobs.append(build_batch_job("chapter_ccvf", prompt, system_prompt=system_prompt))
+                
+                validations = await asyncio.to_thread(batch_llm, jobs)
+                for ch_i, chapter_validation in enumerate(validations[:-1]):
+                    print_validation_result(f"Chapter {ch_i+1}", chapter_validation)
+                validation = validations[-1]
             else:
-                print_status(f"Chapter {ch_i+1} validation passed", "success")
-        
-        # すべての章を検証
-        print_status("=== VALIDATING ALL CHAPTERS ===", "header")
-        validation: str = chapter_level_causal_chain_validation_filter(
-            self.master_plot, self.backstories, self.all_characters_timeline, 
-            self.characters, self.chapter_plots
-        )
-        if "OK" not in validation:
-            print_status(f"Overall chapter validation failed: {validation}", "warning")
-        else:
-            print_status("Overall chapter validation passed", "success")
+                # 全体の因果チェックは、まだ終わっていない章ごとの整合性チェックと並行して実行する
+                chapter_validations, validation = await asyncio.gather(
+                    asyncio.gather(*chapter_validation_tasks),
+                    chapter_level_causal_chain_validation_filter(
+                        self.master_plot, self.backstories, self.timeline_json,
+                        self.characters, chapter_plots_json
+                    ),
+                )
+                # 章ごとの検証結果を章の順に表示する
+                for ch_i, chapter_validation in enumerate(chapter_validations):
+                    print_validation_result(f"Chapter {ch_i+1}", chapter_validation)
+        finally:
+            # 途中で失敗した場合に、終わっていない検証・タイムライン生成のタスクを残さない
+            for chapter_validation_task in chapter_validation_tasks:
+                chapter_validation_task.cancel()
+            if timeline_task is not None:
+                timeline_task.cancel()
+        
+        print_validation_result("Overall chapter", validation)
         
         return self.chapter_plots
     
-    def generate_timeline_for_chapter(self, chapter_index: int) -> List[Dict[str, Any]]:
+    async def generate_timeline_after(self, previous_task: Optional["asyncio.Task[None]"], chapter_index: int) -> None:
+        """
+        前の章のタイムライン生成が終わるのを待ってから、指定された章のタイムラインを生成する
+        （タイムラインは直前の章までの累積なので、章の順に生成する必要がある）
+        
+        Args:
+            previous_task (Optional[asyncio.Task[None]]): 前の章のタイムライン生成タスク
+            chapter_index (int): 章のインデックス
+        """
+        if previous_task is not None:
+            await previous_task
+        await self.generate_timeline_for_chapter(chapter_index)
+    
+    async def generate_timeline_for_chapter(self, chapter_index: int) -> List[Dict[str, Any]]:
         """
         指定された章のタイムラインを生成する
         
@@ -336,40 +577,41 @@ class StoryGenerator:
             List[Dict[str, Any]]: 更新されたタイムライン
         """
         print_status(f"=== TIMELINE LAYER (Chapter {chapter_index+1}) ===", "header")
-        chapter_dir = OUTPUT_DIR / f"chapters/{chapter_index+1:02d}"
-        chapter_timeline_path = chapter_dir / "_timeline.txt"
+        chapter_timeline_path = chapter_output_dir(chapter_index) / "_timeline.txt"
         
-        if self.resume and chapter_timeline_path.exists():
+        if self.resume and (cached_timeline := await aread_from_file(chapter_timeline_path)) is not None:
             print_status(f"Resuming with existing timeline for Chapter {chapter_index+1}", "success")
             try:
-                with open(chapter_timeline_path, 'r', encoding='utf-8') as f:
-                    timeline_data = json.load(f)
-                    # 新しい章なら、タイムラインに追加
-                    if len(self.all_characters_timeline) <= chapter_index:
-                        self.all_characters_timeline.append(timeline_data)
-                    else:
-                        # 既存の章のタイムラインを更新
-                        self.all_characters_timeline[chapter_index] = timeline_data
+                timeline_data = orjson.loads(cached_timeline)
+                # 新しい章なら、タイムラインに追加
+                if len(self.all_characters_timeline) <= chapter_index:
+                    self.all_characters_timeline.append(timeline_data)
+                else:
+                    # 既存の章のタイムラインを更新
+                    self.all_characters_timeline[chapter_index] = timeline_data
             except Exception as e:
                 print_status(f"Error reading timeline from {chapter_timeline_path}: {e}", "error")
                 # タイムラインの読み込みに失敗したら生成
                 print_status(f"Generating new timeline for Chapter {chapter_index+1}...", "info")
-                self.all_characters_timeline = timeline_layer(
+                self.all_characters_timeline = await timeline_layer(
                     self.master_plot, self.backstories, self.characters, 
                     self.chapter_plots, self.all_characters_timeline
                 )
-                save_timeline_to_file(self.all_characters_timeline, chapter_index)
+                if self.persist:
+                    await asyncio.to_thread(save_timeline_to_file, self.all_characters_timeline, chapter_index)
         else:
             print_status(f"Generating new timeline for Chapter {chapter_index+1}...", "info")
-            self.all_characters_timeline = timeline_layer(
+            self.all_characters_timeline = await timeline_layer(
                 self.master_plot, self.backstories, self.characters, 
                 self.chapter_plots, self.all_characters_timeline
             )
-            save_timeline_to_file(self.all_characters_timeline, chapter_index)
+            if self.persist:
+                await asyncio.to_thread(save_timeline_to_file, self.all_characters_timeline, chapter_index)
         
+        self.timeline_json = orjson.dumps(self.all_characters_timeline).decode()
         return self.all_characters_timeline
     
-    def generate_sections(self) -> List[List[str]]:
+    async def generate_sections(self) -> List[List[str]]:
         """
         各章のセクションを生成する
         
@@ -377,15 +619,17 @@ class StoryGenerator:
             List[List[str]]: 章ごとのセクションプロットのリスト
         """
         if not self.chapter_plots:
-            self.generate_chapters()
+            await self.generate_chapters()
         
         print_status("=== GENERATING SECTIONS ===", "header")
         self.section_plots = []
         self.section_intents = []
+        # 章ごとのセクション検証のタスク（章の順）
+        section_validation_tasks: List["asyncio.Task[str]"] = []
         
         for ch_i, chapter_plot in enumerate(self.chapter_plots):
             print_status(f"Processing sections for Chapter {ch_i+1}/{self.chapter_count}", "header")
-            chapter_dir = OUTPUT_DIR / f"chapters/{ch_i+1:02d}"
+            chapter_dir = chapter_output_dir(ch_i)
             
             # セクションレイヤー
             print_status(f"=== SECTION LAYER (Chapter {ch_i+1}) ===", "header")
@@ -394,67 +638,84 @@ class StoryGenerator:
             prev_sections: List[str] = []
             prev_section_intent: Optional[str] = None
             
+            # 章の中では変わらないので、セクションごとではなく章ごとに一度だけ切り出す
+            # これまでの全ての章のセクション
+            all_previous_sections = self.section_plots[:ch_i]
+            # まだセクション化されていない章のプロット
+            remaining_chapter_plots = self.chapter_plots[ch_i+1:]
+            
             # デフォルトでは1章あたり3セクションだが、既存のものがあればそれに合わせる
-            section_count = 3
+            section_count = DEFAULT_SECTION_COUNT
             if self.resume:
                 # 既存のセクションディレクトリをカウント
-                existing_sections = [d for d in chapter_dir.iterdir() if d.is_dir() and d.name.startswith("sec_")]
+                existing_sections = [
+                    e for e in await asyncio.to_thread(scan_dir, chapter_dir)
+                    if e.name.startswith("sec_") and e.is_dir(follow_symlinks=False)
+                ]
                 section_count = max(section_count, len(existing_sections))
                 print_status(f"Found {section_count} existing sections for Chapter {ch_i+1}", "info")
             
             for sec_i in range(section_count):
                 print_status(f"Processing Section {sec_i+1}/{section_count} in Chapter {ch_i+1}", "info")
-                section_dir = chapter_dir / f"sec_{sec_i+1:02d}"
-                ensure_dir(section_dir)
+                section_dir = section_output_dir(ch_i, sec_i)
                 
                 section_plot_path = section_dir / "_plot.txt"
                 section_intent_path = section_dir / "_intent.txt"
                 
-                if self.resume and (cached_section_plot := read_from_file(section_plot_path)) is not None and (cached_section_intent := read_from_file(section_intent_path)) is not None:
+                if self.resume and (cached_section_plot := await aread_from_file(section_plot_path)) is not None and (cached_section_intent := await aread_from_file(section_intent_path)) is not None:
                     print_status(f"Resuming with existing Section {sec_i+1} in Chapter {ch_i+1}", "success")
                     section_plot = cached_section_plot
                     section_intent = cached_section_intent
                 else:
                     print_status(f"Generating new Section {sec_i+1} in Chapter {ch_i+1}...", "info")
-                    # これまでの全ての章のセクションを収集
-                    all_previous_sections = self.section_plots[:ch_i] if ch_i > 0 else []
-                    
-                    # まだセクション化されていない章のプロットを収集
-                    remaining_chapter_plots = []
-                    if ch_i + 1 < len(self.chapter_plots):
-                        remaining_chapter_plots = self.chapter_plots[ch_i+1:]
-                    
-                    section_plot, section_intent = section_layer(
+                    # プロットはストリーミングで確定した時点で保存し、意図の生成完了を待たない
+                    section_plot, section_intent = await section_layer(
                         self.master_plot, self.backstories, self.characters,
                         self.all_characters_timeline, chapter_plot,
                         prev_sections, prev_section_intent,
-                        all_previous_sections, remaining_chapter_plots
+                        all_previous_sections, remaining_chapter_plots,
+                        on_section_plot=partial(asave_to_file, file_path=section_plot_path) if self.persist else None
                     )
-                    save_to_file(section_plot, section_plot_path)
-                    save_to_file(section_intent, section_intent_path)
+                    await self.save_artifact(section_intent, section_intent_path)
                 
                 section_plots.append(section_plot)
                 section_intents.append(section_intent)
                 prev_sections.append(section_plot)
                 prev_section_intent = section_intent
             
-            # セクションを検証
-            print_status(f"=== VALIDATING SECTIONS (Chapter {ch_i+1}) ===", "header")
-            validation: str = section_level_causal_chain_validation_filter(
-                self.master_plot, self.backstories, self.all_characters_timeline,
-                self.characters, chapter_plot, section_plots
-            )
-            if "OK" not in validation:
-                print_status(f"Section validation failed in Chapter {ch_i+1}: {validation}", "warning")
-            else:
-                print_status(f"Section validation passed in Chapter {ch_i+1}", "success")
+            # セクションを検証（バッチモードでは全章分を最後にまとめて検証する）
+            # 検証結果は次の章のセクション生成に使わないので、次の章のセクション生成と並行して進める
+            if not self.batch_mode:
+                print_status(f"=== VALIDATING SECTIONS (Chapter {ch_i+1}) ===", "header")
+                section_validation_tasks.append(asyncio.create_task(section_level_causal_chain_validation_filter(
+                    self.master_plot, self.backstories, self.timeline_json,
+                    self.characters, chapter_plot, section_plots
+                )))
             
             self.section_plots.append(section_plots)
             self.section_intents.append(section_intents)
         
+        # 章ごとの検証結果を章の順に表示する
+        for ch_i, validation in enumerate(await asyncio.gather(*section_validation_tasks)):
+            print_validation_result(f"Sections of Chapter {ch_i+1}", validation)
+        
+        if self.batch_mode:
+            print_status("=== VALIDATING SECTIONS (ALL CHAPTERS) ===", "header")
+            jobs: List[Dict[str, Any]] = []
+            for ch_i, (chapter_plot, section_plots) in enumerate(zip(self.chapter_plots, self.section_plots)):
+                system_prompt, prompt = build_section_level_causal_chain_validation_filter_prompt(
+                    self.master_plot, self.backstories, self.timeline_json,
+                    self.characters, chapter_plot, section_plots
+                )
+                jobs.append(build_batch_job(f"section_ccvf:{ch_i+1:02d}", prompt, system_prompt=system_prompt))
+            
+            validations = await asyncio.to_thread(batch_llm, jobs)
+            for ch_i, validation in enumerate(validations):
+                print_validation_result(f"Sections of Chapter {ch_i+1}", validation)
+        
         return self.section_plots
     
-    def generate_paragraphs(self) -> str:
+    async def generate_paragraphs(self) -> str:
         """
         各セクションの段落を生成し、完全なストーリーテキストを作成する
         
@@ -462,83 +723,307 @@ class StoryGenerator:
             str: 生成された完全なストーリーテキスト
         """
         if not self.section_plots:
-            self.generate_sections()
+            await self.generate_sections()
         
         print_status("=== GENERATING PARAGRAPHS ===", "header")
-        story_text = ""
+        # 章のプロットとセクションが確定した後は、各章の段落生成は互いに独立しているので全章を並列に生成する
+        # （同時に発行されるリクエスト数は LLM 呼び出し側の同時実行数制限で抑えられる）
+        chapter_tasks = [
+            asyncio.create_task(self.generate_chapter_paragraphs(ch_i, section_plots_for_chapter))
+            for ch_i, section_plots_for_chapter in enumerate(self.section_plots)
+        ]
         
-        for ch_i, (chapter_plot, section_plots_for_chapter) in enumerate(zip(self.chapter_plots, self.section_plots)):
-            print_status(f"Processing paragraphs for Chapter {ch_i+1}/{self.chapter_count}", "header")
-            story_text += f"\n\nChapter {ch_i+1}\n\n"
-            chapter_dir = OUTPUT_DIR / f"chapters/{ch_i+1:02d}"
-            
-            for sec_i, section_plot in enumerate(section_plots_for_chapter):
-                print_status(f"=== PARAGRAPH LAYER (Chapter {ch_i+1}, Section {sec_i+1}) ===", "header")
-                story_text += f"\nSection {sec_i+1}\n"
-                section_dir = chapter_dir / f"sec_{sec_i+1:02d}"
-                
-                # パラグラフレイヤー
-                prev_paragraphs: List[str] = []
-                prev_paragraph_intent: Optional[str] = None
-                
-                # デフォルトでは1セクションあたり5段落だが、既存のものがあればそれに合わせる
-                paragraph_count = 5
-                if self.resume:
-                    # 既存の段落ファイルをカウント
-                    existing_paragraphs = [f for f in section_dir.iterdir() 
-                                        if f.is_file() and f.name.endswith(".txt") 
-                                        and not f.name.startswith("_") 
-                                        and not f.name.endswith("_intent.txt")
-                                        and not f.name.endswith("_styled.txt")]
-                    paragraph_count = max(paragraph_count, len(existing_paragraphs))
-                    print_status(f"Found {paragraph_count} existing paragraphs in Section {sec_i+1}, Chapter {ch_i+1}", "info")
-                
-                for para_i in range(paragraph_count):
-                    print_status(f"Processing Paragraph {para_i+1}/{paragraph_count} in Section {sec_i+1}, Chapter {ch_i+1}", "info")
-                    paragraph_path = section_dir / f"{para_i+1:03d}.txt"
-                    paragraph_intent_path = section_dir / f"{para_i+1:03d}_intent.txt"
-                    
-                    if self.resume and (cached_paragraph := read_from_file(paragraph_path)) is not None and (cached_paragraph_intent := read_from_file(paragraph_intent_path)) is not None:
-                        print_status(f"Resuming with existing Paragraph {para_i+1} in Section {sec_i+1}, Chapter {ch_i+1}", "success")
-                        paragraph = cached_paragraph
-                        paragraph_intent = cached_paragraph_intent
-                    else:
-                        print_status(f"Generating new Paragraph {para_i+1} in Section {sec_i+1}, Chapter {ch_i+1}...", "info")
-                        paragraph, paragraph_intent = paragraph_layer(
-                            self.master_plot, self.backstories, self.characters,
-                            self.all_characters_timeline, section_plot,
-                            prev_paragraphs, prev_paragraph_intent
-                        )
-                        save_to_file(paragraph, paragraph_path)
-                        save_to_file(paragraph_intent, paragraph_intent_path)
-                    
-                    # スタイルフィルターを適用
-                    print_status(f"Applying style filter to Paragraph {para_i+1}...", "info")
-                    styled_paragraph: str = style_filter(paragraph)
-                    styled_paragraph_path = section_dir / f"{para_i+1:03d}_styled.txt"
-                    save_to_file(styled_paragraph, styled_paragraph_path)
-                    
-                    story_text += f"\n{styled_paragraph}"
-                    prev_paragraphs.append(paragraph)
-                    prev_paragraph_intent = paragraph_intent
+        # 完成した章から順に完全なストーリーのファイルへ追記していく
+        # （全章が揃うのを待たずに書き出すので、途中で失敗してもそこまでの本文はディスクに残る）
+        complete_story_path = OUTPUT_DIR / "complete_story.txt"
+        story_parts: List[str] = []
+        story_file = await asyncio.to_thread(open, complete_story_path, 'w', encoding='utf-8')
+        try:
+            for ch_i, chapter_task in enumerate(chapter_tasks):
+                chapter_parts = await chapter_task
+                await asyncio.to_thread(write_story_parts, story_file, chapter_parts)
+                print_status(f"Appended Chapter {ch_i+1} to {complete_story_path}", "success")
+                story_parts.extend(chapter_parts)
+        finally:
+            for chapter_task in chapter_tasks:
+                chapter_task.cancel()
+            await asyncio.to_thread(story_file.close)
         
+        # 長い物語でも二乗オーダーのコピーにならないよう、最後に一度だけ連結する
+        story_text = "".join(story_parts)
         self.story_text = story_text
         
-        # 完全なストーリーを保存
-        print_status("=== SAVING COMPLETE STORY ===", "header")
-        complete_story_path = OUTPUT_DIR / "complete_story.txt"
-        save_to_file(story_text, complete_story_path)
-        
         print_status("Story generation completed successfully!", "header")
         print_status(f"Complete story saved to {complete_story_path}", "success")
         
         # ストーリーの長さの統計を表示
-        word_count = len(story_text.split())
-        print_status(f"Generated story with {word_count} words", "success")
+        # 日本語の本文は空白で区切られないので、単語数ではなく文字数で数える（len は文字列を走査しない）
+        print_status(f"Generated story with {len(story_text)} characters", "success")
         
         return story_text
     
-    def generate_until_layer(self, target_layer: Layer) -> Any:
+    async def generate_chapter_paragraphs(self, chapter_index: int, section_plots_for_chapter: List[str]) -> List[str]:
+        """
+        1つの章の全セクションの段落を生成してスタイルフィルターを適用し、章の本文を組み立てる
+        
+        Args:
+            chapter_index (int): 章のインデックス
+            section_plots_for_chapter (List[str]): 章のセクションプロットのリスト
+            
+        Returns:
+            List[str]: 章の本文を構成する文字列のリスト（連結すると章の本文になる）
+        """
+        print_status(f"Processing paragraphs for Chapter {chapter_index+1}/{self.chapter_count}", "header")
+        
+        # 段落は直前の段落に依存するのでセクション内では順に生成するが、
+        # 段落の文脈はセクションごとに独立しているので、セクション同士は並列に生成する
+        if self.style_batch:
+            # バッチモードでは章の全段落が揃ってからまとめてスタイルフィルターを適用する
+            chapter_paragraphs = list(await asyncio.gather(*(
+                self.generate_section_paragraphs(chapter_index, sec_i, section_plot)
+                for sec_i, section_plot in enumerate(section_plots_for_chapter)
+            )))
+            styled_chapter = await self.apply_style_filter_offline(chapter_index, chapter_paragraphs)
+        else:
+            # セクションの段落が揃った時点で、セクション単位の1リクエストでスタイルフィルターを適用する
+            # （他のセクションの段落生成とは並行して進む）
+            styled_chapter = list(await asyncio.gather(*(
+                self.generate_styled_section_paragraphs(chapter_index, sec_i, section_plot)
+                for sec_i, section_plot in enumerate(section_plots_for_chapter)
+            )))
+        
+        story_parts: List[str] = [f"\n\nChapter {chapter_index+1}\n\n"]
+        save_tasks: List[Awaitable[None]] = []
+        for sec_i, styled_paragraphs in enumerate(styled_chapter):
+            story_parts.append(f"\nSection {sec_i+1}\n")
+            section_dir = section_output_dir(chapter_index, sec_i)
+            for para_i, styled_paragraph in enumerate(styled_paragraphs):
+                styled_paragraph_path = section_dir / f"{para_i+1:03d}_styled.txt"
+                save_tasks.append(self.save_artifact(styled_paragraph, styled_paragraph_path))
+                story_parts.append(f"\n{styled_paragraph}")
+        await asyncio.gather(*save_tasks)
+        return story_parts
+    
+    async def generate_styled_section_paragraphs(self, chapter_index: int, section_index: int, section_plot: str) -> List[str]:
+        """
+        1つのセクションの段落を生成し、セクション単位でスタイルフィルターを適用する
+        
+        Args:
+            chapter_index (int): 章のインデックス
+            section_index (int): セクションのインデックス
+            section_plot (str): セクションのプロット
+            
+        Returns:
+            List[str]: スタイル修正済み段落のリスト
+        """
+        paragraphs = await self.generate_section_paragraphs(chapter_index, section_index, section_plot)
+        return await self.apply_style_filter_to_section(paragraphs)
+    
+    async def generate_section_paragraphs(self, chapter_index: int, section_index: int, section_plot: str) -> List[str]:
+        """
+        1つのセクションの段落を順に生成する（再開時は既存の段落を読み込む）
+        
+        Args:
+            chapter_index (int): 章のインデックス
+            section_index (int): セクションのインデックス
+            section_plot (str): セクションのプロット
+            
+        Returns:
+            List[str]: セクションの段落のリスト
+        """
+        print_status(f"=== PARAGRAPH LAYER (Chapter {chapter_index+1}, Section {section_index+1}) ===", "header")
+        section_dir = section_output_dir(chapter_index, section_index)
+        
+        # パラグラフレイヤー
+        section_paragraphs: List[str] = []
+        # 段落生成の文脈に使う直前の段落（古いものは自動的に捨てられる）
+        prev_paragraphs: Deque[str] = deque(maxlen=PREVIOUS_PARAGRAPHS_MAX_COUNT)
+        prev_paragraph_intent: Optional[str] = None
+        # 先頭から何段落を畳み込んだ要約か -> 要約タスク。
+        # 要約を使う段落がディスクにない場合だけ、その2つ前の段落の後に要約を始め、間の段落の生成と並行して走らせる
+        summary_tasks: Dict[int, asyncio.Task[str]] = {}
+        # 最後に始めた要約タスクと、それが畳み込んだ先頭の段落数（次の要約はこの続きから畳み込む）
+        last_summary_task: Optional[asyncio.Task[str]] = None
+        summarized_count = 0
+        # 段落に渡すタイムラインは、セクションのプロットに登場するキャラクターの直近の出来事だけに絞る（セクションごとに一度だけシリアライズする）
+        section_timeline_json = orjson.dumps(
+            select_relevant_timeline(self.all_characters_timeline[-1] if self.all_characters_timeline else {}, section_plot)
+        ).decode()
+        
+        # デフォルトでは1セクションあたり5段落だが、既存のものがあればそれに合わせる
+        paragraph_count = 5
+        # 再開時に読み込めるファイル名（ディレクトリを一度だけ列挙し、存在しないファイルの読み込みを試みない）
+        existing_files: Set[str] = set()
+        if self.resume:
+            # ファイル種別は列挙時に取得済みの情報で判定する
+            existing_files = {
+                e.name for e in await asyncio.to_thread(scan_dir, section_dir)
+                if e.is_file(follow_symlinks=False)
+            }
+            # 既存の段落ファイルをカウント
+            existing_paragraphs = [
+                name for name in existing_files
+                if name.endswith(".txt")
+                and not name.startswith("_")
+                and not name.endswith("_intent.txt")
+                and not name.endswith("_styled.txt")
+            ]
+            paragraph_count = max(paragraph_count, len(existing_paragraphs))
+            print_status(f"Found {paragraph_count} existing paragraphs in Section {section_index+1}, Chapter {chapter_index+1}", "info")
+        
+        try:
+            for para_i in range(paragraph_count):
+                print_status(f"Processing Paragraph {para_i+1}/{paragraph_count} in Section {section_index+1}, Chapter {chapter_index+1}", "info")
+                paragraph_path = section_dir / f"{para_i+1:03d}.txt"
+                paragraph_intent_path = section_dir / f"{para_i+1:03d}_intent.txt"
+                
+                if (
+                    paragraph_path.name in existing_files
+                    and paragraph_intent_path.name in existing_files
+                    and (cached_paragraph := await aread_from_file(paragraph_path)) is not None
+                    and (cached_paragraph_intent := await aread_from_file(paragraph_intent_path)) is not None
+                ):
+                    print_status(f"Resuming with existing Paragraph {para_i+1} in Section {section_index+1}, Chapter {chapter_index+1}", "success")
+                    paragraph = cached_paragraph
+                    paragraph_intent = cached_paragraph_intent
+                else:
+                    # prev_paragraphs より前の段落の要約は、2つ前の段落の後に始めたタスクの結果
+                    prev_paragraphs_summary: Optional[str] = None
+                    if (summarized := para_i - PREVIOUS_PARAGRAPHS_MAX_COUNT) > 0:
+                        if (summary_task := summary_tasks.pop(summarized, None)) is None:
+                            # 一覧にあった段落ファイルを読めなかった場合は先読みしていないので、ここで先頭から畳み込む
+                            # （要約の呼び出しはキャッシュされるので、畳み込み済みの部分は再呼び出ししない）
+                            summary_task = asyncio.create_task(self.fold_paragraph_summary(None, section_paragraphs[:summarized]))
+                        prev_paragraphs_summary = await summary_task
+                    
+                    print_status(f"Generating new Paragraph {para_i+1} in Section {section_index+1}, Chapter {chapter_index+1}...", "info")
+                    # 段落はストリーミングで確定した時点で保存し、意図の生成完了を待たない
+                    paragraph, paragraph_intent = await paragraph_layer(
+                        self.master_plot, self.backstories, self.characters,
+                        section_timeline_json, section_plot,
+                        prev_paragraphs, prev_paragraph_intent,
+                        on_paragraph=partial(asave_to_file, file_path=paragraph_path) if self.persist else None,
+                        paragraph_index=para_i,
+                        previous_paragraphs_summary=prev_paragraphs_summary
+                    )
+                    await self.save_artifact(paragraph_intent, paragraph_intent_path)
+                
+                section_paragraphs.append(paragraph)
+                prev_paragraphs.append(paragraph)
+                prev_paragraph_intent = paragraph_intent
+                
+                # 2つ先の段落を生成する場合は、その段落の窓より前の段落を今のうちに要約に畳み込んでおく
+                # （再開時に読み込むだけの段落のためには要約しない）
+                next_para_i = para_i + 2
+                if (
+                    (summarized := next_para_i - PREVIOUS_PARAGRAPHS_MAX_COUNT) > 0
+                    and next_para_i < paragraph_count
+                    and not (f"{next_para_i+1:03d}.txt" in existing_files and f"{next_para_i+1:03d}_intent.txt" in existing_files)
+                ):
+                    last_summary_task = asyncio.create_task(
+                        self.fold_paragraph_summary(last_summary_task, section_paragraphs[summarized_count:summarized])
+                    )
+                    summary_tasks[summarized] = last_summary_task
+                    summarized_count = summarized
+        finally:
+            # 途中で失敗した場合に、使われなくなった要約タスクを残さない
+            for summary_task in summary_tasks.values():
+                summary_task.cancel()
+        
+        return section_paragraphs
+    
+    async def fold_paragraph_summary(self, previous_summary_task: Optional[Awaitable[str]], paragraphs: List[str]) -> str:
+        """
+        直前の要約タスクの完了を待ち、その要約に段落を順に畳み込む
+        
+        Args:
+            previous_summary_task (Optional[Awaitable[str]]): それまでの段落を畳み込む要約タスク（最初の段落ではNone）
+            paragraphs (List[str]): 要約に加える段落（再開時に読み込んだ段落の分、複数になることがある）
+            
+        Returns:
+            str: 更新された要約
+        """
+        summary = await previous_summary_task if previous_summary_task is not None else None
+        for paragraph in paragraphs:
+            summary = await summarize_previous_paragraphs(summary, paragraph)
+        return summary or ""
+    
+    async def apply_style_filter_offline(self, chapter_index: int, chapter_paragraphs: List[List[str]]) -> List[List[str]]:
+        """
+        バッチモードで章内の全段落にスタイルフィルターを適用する。
+        段落数が多ければ Batch API に、少なければセクションごとのまとめリクエストを並列に送る。
+        
+        Args:
+            chapter_index (int): 章のインデックス
+            chapter_paragraphs (List[List[str]]): セクションごとの段落のリスト
+            
+        Returns:
+            List[List[str]]: セクションごとのスタイル修正済み段落のリスト
+        """
+        paragraph_count = sum(len(paragraphs) for paragraphs in chapter_paragraphs)
+        if paragraph_count > STYLE_BATCH_THRESHOLD:
+            return await self.apply_style_filter_batch(chapter_index, chapter_paragraphs)
+        
+        print_status(f"Applying style filter to {paragraph_count} paragraphs in Chapter {chapter_index+1} per section...", "info")
+        return list(await asyncio.gather(*(self.apply_style_filter_to_section(paragraphs) for paragraphs in chapter_paragraphs)))
+    
+    async def apply_style_filter_to_section(self, paragraphs: List[str]) -> List[str]:
+        """
+        セクション内の段落にスタイルフィルターを適用する。
+        2段落以上なら1リクエストにまとめ、失敗した場合は段落ごとのリクエストに戻す。
+        
+        Args:
+            paragraphs (List[str]): セクション内の段落のリスト
+            
+        Returns:
+            List[str]: スタイル修正済み段落のリスト
+        """
+        if len(paragraphs) > 1:
+            try:
+                return await section_style_filter(paragraphs)
+            except ValueError as e:
+                print_status(f"Section style filter failed, falling back to per-paragraph requests: {e}", "warning")
+            except LLMCallError as e:
+                # リトライを使い切った場合は段落ごとに送り直しても失敗するので、修正前の段落をそのまま使う
+                print_status(f"Section style filter failed, keeping the unstyled paragraphs: {e}", "warning")
+                return list(paragraphs)
+        return list(await asyncio.gather(*(style_filter(paragraph) for paragraph in paragraphs)))
+    
+    async def apply_style_filter_batch(self, chapter_index: int, chapter_paragraphs: List[List[str]]) -> List[List[str]]:
+        """
+        章内の全段落に、Batch API の1ジョブとしてスタイルフィルターを適用する。
+        
+        Args:
+            chapter_index (int): 章のインデックス
+            chapter_paragraphs (List[List[str]]): セクションごとの段落のリスト
+            
+        Returns:
+            List[List[str]]: セクションごとのスタイル修正済み段落のリスト
+        """
+        indexed_paragraphs = [
+            (sec_i, para_i, paragraph)
+            for sec_i, paragraphs in enumerate(chapter_paragraphs)
+            for para_i, paragraph in enumerate(paragraphs)
+        ]
+        print_status(f"Applying style filter to {len(indexed_paragraphs)} paragraphs in Chapter {chapter_index+1}...", "info")
+        
+        jobs = [
+            build_batch_job(f"style:{chapter_index+1:02d}-{sec_i+1:02d}-{para_i+1:03d}", build_style_filter_prompt(paragraph), model=STYLE_FILTER_MODEL)
+            for sec_i, para_i, paragraph in indexed_paragraphs
+        ]
+        styled: List[str] = await asyncio.to_thread(batch_llm, jobs)
+        
+        # セクションごとのリストに戻す
+        styled_chapter: List[List[str]] = [[] for _ in chapter_paragraphs]
+        for (sec_i, para_i, paragraph), styled_paragraph in zip(indexed_paragraphs, styled):
+            if styled_paragraph.startswith("Error:"):
+                # 失敗したリクエストはエラーメッセージを本文に混ぜず、修正前の段落をそのまま使う
+                print_status(f"Style filter failed for Paragraph {para_i+1} in Section {sec_i+1}, Chapter {chapter_index+1}, keeping the unstyled paragraph: {styled_paragraph}", "warning")
+                styled_paragraph = paragraph
+            styled_chapter[sec_i].append(styled_paragraph)
+        return styled_chapter
+    
+    async def generate_until_layer(self, target_layer: Layer) -> Any:
         """
         指定されたレイヤーまで物語を生成する
         
@@ -549,27 +1034,47 @@ class StoryGenerator:
             Any: 最後に生成されたレイヤーの結果
         """
         if target_layer == Layer.PLOT:
-            return self.generate_plot()
+            return await self.generate_plot()
         elif target_layer == Layer.BACKSTORY:
-            return self.generate_backstory()
+            return await self.generate_backstory()
         elif target_layer == Layer.CHARACTER:
-            return self.generate_characters()
+            return await self.generate_characters()
         elif target_layer == Layer.CHAPTER:
-            return self.generate_chapters()
+            return await self.generate_chapters()
         elif target_layer == Layer.TIMELINE:
-            self.generate_chapters()  # タイムラインは章と一緒に生成される
+            await self.generate_chapters()  # タイムラインは章と一緒に生成される
             return self.all_characters_timeline
         elif target_layer == Layer.SECTION:
-            return self.generate_sections()
+            return await self.generate_sections()
         elif target_layer == Layer.PARAGRAPH:
-            return self.generate_paragraphs()
+            return await self.generate_paragraphs()
         elif target_layer == Layer.STYLE:
-            return self.generate_paragraphs()  # スタイルは段落と一緒に適用される
+            return await self.generate_paragraphs()  # スタイルは段落と一緒に適用される
         elif target_layer == Layer.ALL:
-            return self.generate_paragraphs()
+            return await self.generate_paragraphs()
         else:
             raise ValueError(f"Unknown layer: {target_layer}")
 
+async def run_generator(generator: StoryGenerator, target_layer: Layer) -> Any:
+    """
+    指定されたレイヤーまで物語を生成し、終了時に共有の HTTP クライアントを閉じる
+    
+    Args:
+        generator (StoryGenerator): 物語生成器
+        target_layer (Layer): 生成を停止するレイヤー
+        
+    Returns:
+        Any: 最後に生成されたレイヤーの結果
+    """
+    try:
+        return await generator.generate_until_layer(target_layer)
+    finally:
+        await aclose_llm_clients()
+        if (summary := llm_cache_summary()) is not None:
+            print_status(summary, "info")
+        if (summary := prompt_cache_summary()) is not None:
+            print_status(summary, "info")
+
 def parse_args() -> argparse.Namespace:
     """
     コマンドライン引数をパースする
@@ -594,6 +1099,18 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--prompt-file', type=str,
                         help='プロンプトを含むファイルのパス')
     
+    parser.add_argument('--batch', action='store_true',
+                        help='バリデーション・スタイルフィルターを OpenAI Batch API でまとめて実行する (安価だが完了まで時間がかかる)')
+    
+    parser.add_argument('--style-batch', action='store_true',
+                        help='スタイルフィルターだけを OpenAI Batch API でまとめて実行する (バリデーションは通常どおり実行する)')
+    
+    parser.add_argument('--no-save', action='store_true',
+                        help='途中の生成物を保存せず、完全なストーリーだけを保存する (--resume で再開できなくなる)')
+    
+    parser.add_argument('--verbose', action='store_true',
+                        help='ファイルの読み書きなどの詳細なログも表示する')
+    
     return parser.parse_args()
 
 def main() -> None:
@@ -601,6 +1118,7 @@ def main() -> None:
     メイン関数
     """
     args = parse_args()
+    setup_logging(args.verbose)
     
     # プロンプトの取得
     if args.prompt:
@@ -630,8 +1148,8 @@ def main() -> None:
     
     # ストーリー生成
     try:
-        generator = StoryGenerator(user_input, chapter_count=args.chapters, resume=args.resume)
-        result = generator.generate_until_layer(target_layer)
+        generator = StoryGenerator(user_input, chapter_count=args.chapters, resume=args.resume, batch_mode=args.batch, persist=not args.no_save, style_batch=args.style_batch)
+        result = asyncio.run(run_generator(generator, target_layer))
         
         print_status(f"Story generation completed until layer: {target_layer.value}", "header")
     except Exception as e:
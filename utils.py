@@ -1,60 +1,932 @@
 import os
+import re
 import time
-import random
+import json
+import asyncio
+import atexit
+import hashlib
+from pathlib import Path
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+import httpx
+import httpx2
+import orjson
+import tiktoken
 from dotenv import load_dotenv
+from openai import OpenAI, DefaultHttpxClient, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    Retrying,
+    retry_base,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 
 # Load environment variables
 load_dotenv()
 
-def call_llm(prompt: str, json_mode: bool = False, max_retries: int = 3, initial_backoff: float = 1.0) -> str:
+# 同時に発行する LLM リクエスト数の上限（プロバイダの RPM/TPM に合わせて調整する）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# 1分あたりに送るトークン数の上限（プロバイダの TPM に合わせて指定する）。0 以下なら制限しない
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+# max_tokens を指定しない呼び出しで、TPM の見積もりに使う出力トークン数
+LLM_ESTIMATED_OUTPUT_TOKENS = 1000
+
+# 全 LLM 呼び出しで共有する HTTP クライアント。
+# リクエストごとに接続を張らず、TLS ハンドシェイクをプロセスあたり一度に抑え、HTTP/2 で並列リクエストを多重化する
+# アイドル接続の保持時間は既定の 5 秒では短く、前後の処理を挟むたびに TLS ハンドシェイクからやり直しになるので延ばす
+LLM_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30.0)
+LLM_HTTP_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+_http_client = httpx.Client(limits=LLM_HTTP_LIMITS, timeout=LLM_HTTP_TIMEOUT, http2=True)
+_async_http_client = httpx.AsyncClient(limits=LLM_HTTP_LIMITS, timeout=LLM_HTTP_TIMEOUT, http2=True)
+atexit.register(_http_client.close)
+
+async def aclose_llm_clients() -> None:
+    """
+    共有の非同期 HTTP クライアントを閉じる。
+    イベントループの終了前（asyncio.run に渡すコルーチンの最後）に一度だけ呼ぶこと。
+    """
+    await _async_http_client.aclose()
+
+# リトライ対象のエラー（レート制限・タイムアウト・接続エラー・サーバー側の一時的なエラー）
+RETRYABLE_LLM_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+# リトライ間隔の上限（秒）
+LLM_RETRY_MAX_BACKOFF = 30.0
+
+class LLMCallError(RuntimeError):
+    """
+    リトライを使い切っても LLM 呼び出しが成功しなかった場合に送出する例外。
+    応答テキストと区別できるよう、エラーメッセージを文字列として返さずにこの例外を送出する
+    """
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD 方式で同時実行数を調整するリミッター。
+    レート制限（429）を受けたら上限を半分に下げ、成功が続いたら1ずつ元の上限まで戻す。
+    """
+
+    def __init__(self, max_limit: int, increase_after: int = 20):
+        """
+        Args:
+            max_limit (int): 同時実行数の上限
+            increase_after (int): 上限を1上げるまでに必要な連続成功回数
+        """
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.increase_after = increase_after
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def __aexit__(self, exc_type: Any, exc: Optional[BaseException], tb: Any) -> bool:
+        async with self._condition:
+            self._in_flight -= 1
+            if isinstance(exc, RateLimitError):
+                self._successes = 0
+                if self.limit > 1:
+                    self.limit = max(1, self.limit // 2)
+                    print(f"Rate limited; reducing LLM concurrency to {self.limit}")
+            elif exc_type is None:
+                self._successes += 1
+                if self._successes >= self.increase_after and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+        return False
+
+_llm_limiter = AdaptiveConcurrencyLimiter(LLM_MAX_CONCURRENCY)
+
+class TokenRateLimiter:
+    """
+    1分あたりのトークン数（TPM）を制限するトークンバケット。
+    リクエストの前に推定トークン数を acquire し、バケットが足りなければ補充されるまで待つ。
+    待っているリクエストは到着順に通す。
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        """
+        Args:
+            tokens_per_minute (int): 1分あたりのトークン数の上限（0 以下なら制限しない）
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self._available = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.tokens_per_minute > 0
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        トークンを消費する。足りなければ補充されるまで待つ
+
+        Args:
+            tokens (int): リクエストの推定トークン数（上限を超える場合は上限として扱う）
+        """
+        if not self.enabled:
+            return
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                refill = (now - self._updated_at) * self.tokens_per_minute / 60
+                self._available = min(self.tokens_per_minute, self._available + refill)
+                self._updated_at = now
+                if self._available >= tokens:
+                    self._available -= tokens
+                    return
+                await asyncio.sleep((tokens - self._available) * 60 / self.tokens_per_minute)
+
+_token_limiter = TokenRateLimiter(LLM_TOKENS_PER_MINUTE)
+
+LLM_MODEL = "gpt-4o"  # or another appropriate model
+LLM_TEMPERATURE = 0.7
+# OpenAI 互換 API のエンドポイント（vLLM など自前のサーバーを使う場合に指定。未指定なら OpenAI）
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+# バリデーションの一次判定など、短い定型出力だけが必要な呼び出しに使う安価なモデル
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gpt-4o-mini")
+# LLM_FAST_MODEL だけを別のエンドポイント（量子化モデルを載せた vLLM など）に向ける場合に指定。未指定なら LLM_BASE_URL と同じ
+LLM_FAST_BASE_URL = os.getenv("LLM_FAST_BASE_URL") or LLM_BASE_URL
+
+# LLM 応答のディスクキャッシュ（同一プロンプトの再呼び出しをファイル読み込みで済ませる）
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", "~/.mlsg/llm_cache")).expanduser()
+# キャッシュの有効期間（秒）。0 以下なら無期限
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "0"))
+# LLM_CACHE=0 でキャッシュの読み書きを無効にする（同じ入力から別の物語を生成し直したい場合など）
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+# 物語を生成するレイヤー（temperature > 0）の応答もキャッシュするか（LLM_CACHE_GENERATIVE=1 で有効）。
+# 無効なら、出力ファイルを削除して --resume すれば生成し直される。キャッシュするのは要約・検証・スタイルフィルターのみ
+LLM_CACHE_GENERATIVE = os.getenv("LLM_CACHE_GENERATIVE", "0") == "1"
+_cache_stats = {"hits": 0, "misses": 0}
+# プロバイダのプロンプトキャッシュの効き具合（入力トークン数のうちキャッシュから読まれた数）
+_prompt_token_stats = {"prompt_tokens": 0, "cached_tokens": 0}
+# 実行中のキャッシュ対象リクエスト（キャッシュキー -> 応答の Future）。同一リクエストの重複送信を防ぐ
+_inflight_requests: Dict[str, "asyncio.Future[str]"] = {}
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    モデルに対応する tiktoken のエンコーディングを取得する（初回のみロード）
+    """
+    return tiktoken.encoding_for_model(model)
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = LLM_MODEL) -> int:
+    """
+    テキストのトークン数を数える。
+    同じ段落や章のプロットは後続の呼び出しで何度も数えられるため、結果をキャッシュする
+
+    Args:
+        text (str): 対象のテキスト
+        model (str): トークナイザーを選ぶためのモデル名
+
+    Returns:
+        int: トークン数
+    """
+    return len(_get_encoding(model).encode(text))
+
+def budget_pack(items: Sequence[str], max_tokens: int, model: str = LLM_MODEL) -> List[str]:
+    """
+    新しいもの（末尾）から順に、合計トークン数が予算に収まるだけ要素を詰める。
+    文脈が途切れないよう、最新の要素は予算を超えていても必ず含める。
+
+    Args:
+        items (Sequence[str]): 古い順に並んだテキストのリスト（deque も可）
+        max_tokens (int): トークン予算
+        model (str): トークナイザーを選ぶためのモデル名
+
+    Returns:
+        List[str]: 予算に収まった末尾の要素（元の順序のまま）
+    """
+    packed: List[str] = []
+    used_tokens = 0
+    for item in reversed(items):
+        item_tokens = count_tokens(item, model)
+        if packed and used_tokens + item_tokens > max_tokens:
+            break
+        packed.append(item)
+        used_tokens += item_tokens
+    packed.reverse()
+    return packed
+
+@lru_cache(maxsize=8)
+def build_story_context(master_plot: str, backstories: Optional[str] = None, characters: Optional[str] = None) -> str:
+    """
+    全レイヤー・フィルターで共通の物語コンテキスト（システムプロンプト）を組み立てる。
+    プロバイダのプレフィックスキャッシュを効かせるため、呼び出しごとに変わる値は
+    一切含めず、常に同じ順序・同じ書式でバイト単位まで一致させること。
+    世界観設定・キャラクター設定がまだない段階（Backstory / Character Layer）では省略でき、
+    その場合の出力は全部そろった場合の出力の先頭部分と一致する。
+    入力は物語全体を通して変わらないのでキャッシュし、全呼び出しで同じ文字列オブジェクトを返す
+    （後段のキャッシュキー計算やトークン数のキャッシュでも、長い文字列の組み立て・ハッシュ計算を繰り返さない）。
+
+    Args:
+        master_plot (str): マスタープロット
+        backstories (Optional[str]): 世界観設定
+        characters (Optional[str]): キャラクター設定（backstories を省略した場合は無視される）
+
+    Returns:
+        str: システムプロンプトとして渡す共通コンテキスト
+    """
+    context = (
+        "あなたは多層的物語生成システムの一部です。以下の物語設定を前提に、ユーザーの指示に従ってください。\n\n"
+        f"# マスタープロット\n{master_plot}\n\n"
+    )
+    if backstories is None:
+        return context
+    context += f"# 世界観設定\n{backstories}\n\n"
+    if characters is None:
+        return context
+    return context + f"# キャラクター設定\n{characters}\n"
+
+def _build_messages(prompt: str, system_prompt: Optional[str]) -> List[BaseMessage]:
+    """
+    システムプロンプト（不変のプレフィックス）とユーザープロンプト（呼び出しごとの差分）からメッセージ列を作る
+    """
+    if system_prompt:
+        return [SystemMessage(content=system_prompt), HumanMessage(content=prompt)]
+    return [HumanMessage(content=prompt)]
+
+def _normalize_prompt(text: Optional[str]) -> Optional[str]:
+    """
+    キャッシュキー用にプロンプトを正規化する。
+    各行の前後の空白と連続する空行を取り除き、インデントや改行だけが異なるプロンプトを同一とみなす
+    """
+    if text is None:
+        return None
+    lines = [line.strip() for line in text.strip().splitlines()]
+    return "\n".join(line for i, line in enumerate(lines) if line or (i > 0 and lines[i - 1]))
+
+@lru_cache(maxsize=16)
+def _normalize_system_prompt(system_prompt: Optional[str]) -> Optional[str]:
+    """
+    システムプロンプト（物語コンテキスト）の正規化結果をキャッシュする。
+    システムプロンプトは全呼び出しでほぼ共通なので、長い文字列の正規化を呼び出しごとに繰り返さない
+    """
+    return _normalize_prompt(system_prompt)
+
+def _cache_key(prompt: str, json_mode: bool, system_prompt: Optional[str] = None, json_schema: Optional[Dict[str, Any]] = None, model: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE, max_tokens: Optional[int] = None, n: int = 1) -> str:
+    """
+    モデル・正規化したプロンプト・JSONモードからキャッシュキー（SHA-256）を計算する。
+    候補数 n は 1 のときはキーに含めない（既存のキャッシュのキーを変えないため）
+    """
+    payload_fields: Dict[str, Any] = {"model": model, "temperature": temperature, "max_tokens": max_tokens, "system_prompt": _normalize_system_prompt(system_prompt), "prompt": _normalize_prompt(prompt), "json_mode": json_mode, "json_schema": json_schema}
+    if n != 1:
+        payload_fields["n"] = n
+    payload = json.dumps(payload_fields, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _cache_get(key: str) -> Optional[str]:
+    """
+    キャッシュから応答を取得する。存在しないか期限切れ、またはキャッシュが無効なら None を返す
+    """
+    if not LLM_CACHE_ENABLED:
+        return None
+    cache_path = LLM_CACHE_DIR / f"{key}.json"
+    try:
+        entry = orjson.loads(cache_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        entry = None
+
+    if entry is not None and (LLM_CACHE_TTL <= 0 or time.time() - entry["ts"] <= LLM_CACHE_TTL):
+        _cache_stats["hits"] += 1
+        return entry["response"]
+
+    _cache_stats["misses"] += 1
+    return None
+
+def _cache_put(key: str, response: str) -> None:
+    """
+    応答をキャッシュに保存する。保存に失敗しても生成処理は止めない
+    """
+    if not LLM_CACHE_ENABLED:
+        return
+    cache_path = LLM_CACHE_DIR / f"{key}.json"
+    # 一時ファイルに書いてから置き換え、書き込み途中で中断されたり複数プロセスが同時に書いたりしても
+    # 読み込み側が途中までのファイルを見ないようにする
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        LLM_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(orjson.dumps({"response": response, "ts": time.time()}))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Failed to write LLM cache: {e}")
+        tmp_path.unlink(missing_ok=True)
+
+def llm_cache_summary() -> Optional[str]:
+    """
+    ディスクキャッシュのヒット率を1行にまとめる（呼び出しごとには表示せず、実行の最後に一度だけ表示する）
+
+    Returns:
+        Optional[str]: 集計結果（キャッシュを参照した呼び出しがない場合は None）
+    """
+    hits = _cache_stats["hits"]
+    total = hits + _cache_stats["misses"]
+    if total == 0:
+        return None
+    return f"LLM cache hits: {hits}/{total} ({hits / total:.0%})"
+
+def _record_prompt_usage(response: Any) -> None:
+    """
+    応答のトークン使用量から、入力トークン数とプロンプトキャッシュに載ったトークン数を集計する
+    """
+    _record_token_usage((getattr(response, "response_metadata", None) or {}).get("token_usage"))
+
+def _record_token_usage(token_usage: Optional[Dict[str, Any]]) -> None:
+    """
+    API の usage（token_usage）から、入力トークン数とプロンプトキャッシュに載ったトークン数を集計する
+    """
+    token_usage = token_usage or {}
+    _prompt_token_stats["prompt_tokens"] += token_usage.get("prompt_tokens") or 0
+    _prompt_token_stats["cached_tokens"] += (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+def _record_usage_metadata(usage_metadata: Optional[Dict[str, Any]]) -> None:
+    """
+    ストリーミング応答の最後のチャンクに付く usage_metadata から、入力トークン数とプロンプトキャッシュに載ったトークン数を集計する
+    """
+    usage_metadata = usage_metadata or {}
+    _prompt_token_stats["prompt_tokens"] += usage_metadata.get("input_tokens") or 0
+    _prompt_token_stats["cached_tokens"] += (usage_metadata.get("input_token_details") or {}).get("cache_read") or 0
+
+def prompt_cache_summary() -> Optional[str]:
+    """
+    プロバイダのプロンプトキャッシュの効き具合を1行にまとめる。
+    システムプロンプト（共通の物語コンテキスト）が先頭に置かれ、バイト単位で一致していれば cached の割合が上がる
+
+    Returns:
+        Optional[str]: 集計結果（まだ LLM を呼び出していない場合は None）
+    """
+    prompt_tokens = _prompt_token_stats["prompt_tokens"]
+    if prompt_tokens == 0:
+        return None
+    cached_tokens = _prompt_token_stats["cached_tokens"]
+    return f"Prompt tokens: {prompt_tokens} ({cached_tokens} cached = {cached_tokens / prompt_tokens:.0%})"
+
+def _retry_after_seconds(error: Optional[BaseException]) -> Optional[float]:
+    """
+    エラーレスポンスの retry-after-ms / retry-after ヘッダーから待機秒数を取り出す
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+    try:
+        if (retry_after_ms := headers.get("retry-after-ms")) is not None:
+            return float(retry_after_ms) / 1000
+        if (retry_after := headers.get("retry-after")) is not None:
+            return float(retry_after)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def _log_retry(retry_state: RetryCallState) -> None:
+    """
+    リトライ前に失敗内容と待機時間を表示する
+    """
+    error = retry_state.outcome.exception() if retry_state.outcome else None
+    sleep_time = retry_state.next_action.sleep if retry_state.next_action else 0
+    print(f"Attempt {retry_state.attempt_number} failed with error: {error}. Retrying in {sleep_time:.2f} seconds...")
+
+def _retry_policy(max_retries: int, initial_backoff: float, retry: Optional[retry_base] = None) -> Dict[str, Any]:
+    """
+    tenacity の Retrying / AsyncRetrying に渡すリトライ設定を組み立てる。
+    ジッター付き指数バックオフで待機し、サーバーが retry-after を指定した場合はそれ以上待つ。
+
+    Args:
+        max_retries (int): 最大リトライ回数
+        initial_backoff (float): 初期バックオフ時間（秒）
+        retry (Optional[retry_base]): リトライ条件（デフォルト: RETRYABLE_LLM_ERRORS のいずれか）
+
+    Returns:
+        Dict[str, Any]: Retrying / AsyncRetrying のキーワード引数
+    """
+    backoff = wait_exponential_jitter(initial=initial_backoff, max=LLM_RETRY_MAX_BACKOFF)
+
+    def wait(retry_state: RetryCallState) -> float:
+        delay = backoff(retry_state)
+        error = retry_state.outcome.exception() if retry_state.outcome else None
+        if (retry_after := _retry_after_seconds(error)) is not None:
+            return max(delay, retry_after)
+        return delay
+
+    return {
+        "stop": stop_after_attempt(max_retries + 1),
+        "wait": wait,
+        "retry": retry if retry is not None else retry_if_exception_type(RETRYABLE_LLM_ERRORS),
+        "before_sleep": _log_retry,
+        "reraise": True,
+    }
+
+def evict_llm_cache(prompt: str, json_mode: bool = False, system_prompt: Optional[str] = None, json_schema: Optional[Dict[str, Any]] = None, model: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE, max_tokens: Optional[int] = None, n: int = 1) -> None:
+    """
+    キャッシュ済みの応答を削除する。
+    呼び出し側で応答のパースに失敗した場合に使い、不正な応答が再実行時にも返り続けないようにする。
+    引数は応答を取得したときの call_llm / acall_llm / acall_llm_candidates と同じものを渡すこと。
+    """
+    key = _cache_key(prompt, json_mode, system_prompt, json_schema, model, temperature, max_tokens, n)
+    try:
+        (LLM_CACHE_DIR / f"{key}.json").unlink(missing_ok=True)
+    except OSError as e:
+        print(f"Failed to evict LLM cache: {e}")
+
+def _build_response_format(json_mode: bool, json_schema: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    OpenAI の response_format パラメータを組み立てる。
+    json_schema が指定された場合は Structured Outputs（strict）を使い、サーバー側で形式を保証させる。
+    """
+    if json_schema is not None:
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": json_schema.get("title", "response"), "schema": json_schema, "strict": True},
+        }
+    if json_mode:
+        return {"type": "json_object"}
+    return None
+
+@lru_cache(maxsize=16)
+def _prompt_cache_key(system_prompt: str) -> str:
     """
-    OpenAI LLMへのAPI呼び出しを行い、応答を返す。失敗した場合は自動的にリトライする。
-    
+    システムプロンプトから OpenAI の prompt_cache_key を計算する。
+    同じプレフィックスを持つリクエストが同じキャッシュに振り分けられやすくなる
+    """
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:32]
+
+# 生成済みの ChatOpenAI インスタンス（設定 -> インスタンス）。呼び出しごとにクライアントを組み立て直さない
+_llm_instances: Dict[Tuple[Any, ...], ChatOpenAI] = {}
+
+def _build_llm(json_mode: bool = False, json_schema: Optional[Dict[str, Any]] = None, model: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE, max_tokens: Optional[int] = None, system_prompt: Optional[str] = None) -> ChatOpenAI:
+    """
+    call_llm / acall_llm で共通して使う ChatOpenAI インスタンスを返す。
+    同じ設定のインスタンスは一度だけ生成して使い回す（HTTP クライアントは全インスタンスで共有）。
+
+    Args:
+        json_mode (bool): JSONモードを有効にするかどうか
+        json_schema (Optional[Dict[str, Any]]): 出力を強制する JSON Schema
+        model (str): 使用するモデル名
+        temperature (float): サンプリング温度
+        max_tokens (Optional[int]): 出力トークン数の上限（None なら無制限）
+        system_prompt (Optional[str]): システムプロンプト。指定した場合は prompt_cache_key を付与する
+
+    Returns:
+        ChatOpenAI: 設定済みのLLMクライアント
+    """
+    instance_key = (
+        json_mode,
+        json.dumps(json_schema, sort_keys=True) if json_schema is not None else None,
+        model,
+        temperature,
+        max_tokens,
+        _prompt_cache_key(system_prompt) if system_prompt else None,
+    )
+    if (llm := _llm_instances.get(instance_key)) is not None:
+        return llm
+
+    # Initialize the OpenAI LLM with appropriate parameters
+    llm_params: Dict[str, Any] = {
+        "model": model,
+        "temperature": temperature,
+        "model_kwargs": {},  # 追加：model_kwargsディクショナリを初期化
+        # 接続プールを全呼び出しで共有する
+        "http_client": _http_client,
+        "http_async_client": _async_http_client,
+        # ストリーミングでも最後のチャンクに usage を付けてもらい、プロンプトキャッシュの集計に含める
+        "stream_usage": True,
+    }
+    if base_url := (LLM_FAST_BASE_URL if model == LLM_FAST_MODEL else LLM_BASE_URL):
+        llm_params["base_url"] = base_url
+    if max_tokens is not None:
+        llm_params["max_tokens"] = max_tokens
+    if system_prompt:
+        llm_params["extra_body"] = {"prompt_cache_key": _prompt_cache_key(system_prompt)}
+
+    # Add JSON mode if requested
+    if (response_format := _build_response_format(json_mode, json_schema)) is not None:
+        llm_params["model_kwargs"]["response_format"] = response_format
+
+    # Initialize the OpenAI LLM
+    llm = _llm_instances[instance_key] = ChatOpenAI(**llm_params)
+    return llm
+
+def call_llm(prompt: str, json_mode: bool = False, max_retries: int = 5, initial_backoff: float = 1.0, cache: bool = False, system_prompt: Optional[str] = None, json_schema: Optional[Dict[str, Any]] = None, model: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE, max_tokens: Optional[int] = None) -> str:
+    """
+    OpenAI LLMへのAPI呼び出しを行い、応答を返す。
+    レート制限や一時的なエラーの場合は自動的にリトライし、リトライを使い切った場合は LLMCallError を送出する。
+    認証エラーや不正なリクエストなど、リトライしても解決しないエラーは例外をそのまま送出する。
+
     Args:
         prompt (str): LLMに送信するプロンプト
         json_mode (bool): JSONモードを有効にするかどうか（デフォルト: False）
-        max_retries (int): 最大リトライ回数（デフォルト: 3）
+        max_retries (int): 最大リトライ回数（デフォルト: 5）
         initial_backoff (float): 初期バックオフ時間（秒）（デフォルト: 1.0）
-        
+        cache (bool): ディスクキャッシュを使うかどうか（デフォルト: False）
+        system_prompt (Optional[str]): 呼び出し間で不変のシステムプロンプト（build_story_context の出力など）
+        json_schema (Optional[Dict[str, Any]]): 出力を強制する JSON Schema（pydantic の model_json_schema() など）
+        model (str): 使用するモデル名（デフォルト: LLM_MODEL。一次判定などには LLM_FAST_MODEL）
+        temperature (float): サンプリング温度（デフォルト: LLM_TEMPERATURE）
+        max_tokens (Optional[int]): 出力トークン数の上限（デフォルト: None）
+
     Returns:
         str: LLMからの応答テキスト
+
+    Raises:
+        LLMCallError: リトライを使い切っても呼び出しが成功しなかった場合
+        Exception: RETRYABLE_LLM_ERRORS 以外のエラー（認証エラー・不正なリクエストなど）
     """
-    # Initialize the OpenAI LLM with appropriate parameters
-    llm_params = {
-        "model": "gpt-4o",  # or another appropriate model
-        "temperature": 0.7,
-        "model_kwargs": {}  # 追加：model_kwargsディクショナリを初期化
+    if cache:
+        key = _cache_key(prompt, json_mode, system_prompt, json_schema, model, temperature, max_tokens)
+        if (cached_response := _cache_get(key)) is not None:
+            return cached_response
+
+    llm = _build_llm(json_mode, json_schema, model, temperature, max_tokens, system_prompt)
+
+    # Create messages with the (cacheable) system prefix first
+    messages = _build_messages(prompt, system_prompt)
+
+    try:
+        for attempt in Retrying(**_retry_policy(max_retries, initial_backoff)):
+            with attempt:
+                # Get the response from the LLM
+                response = llm.invoke(messages)
+        _record_prompt_usage(response)
+    except RETRYABLE_LLM_ERRORS as e:
+        raise LLMCallError(f"LLM 呼び出しに失敗しました: {e}") from e
+
+    # Return the content of the response as a string
+    response_text = str(response.content)
+    if cache:
+        _cache_put(key, response_text)
+    return response_text
+
+async def acall_llm(prompt: str, json_mode: bool = False, max_retries: int = 5, initial_backoff: float = 1.0, cache: bool = False, system_prompt: Optional[str] = None, json_schema: Optional[Dict[str, Any]] = None, model: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE, max_tokens: Optional[int] = None) -> str:
+    """
+    call_llm の非同期版。asyncio.gather で兄弟呼び出しを並列に発行できるようにする。
+    同時実行数は LLM_MAX_CONCURRENCY（環境変数で変更可能）を上限に、レート制限の状況に応じて自動で調整される。
+
+    Args:
+        prompt (str): LLMに送信するプロンプト
+        json_mode (bool): JSONモードを有効にするかどうか（デフォルト: False）
+        max_retries (int): 最大リトライ回数（デフォルト: 5）
+        initial_backoff (float): 初期バックオフ時間（秒）（デフォルト: 1.0）
+        cache (bool): ディスクキャッシュを使うかどうか（デフォルト: False）。
+            有効な場合、実行中の同一リクエストへの呼び出しは1つにまとめられる
+        system_prompt (Optional[str]): 呼び出し間で不変のシステムプロンプト（build_story_context の出力など）
+        json_schema (Optional[Dict[str, Any]]): 出力を強制する JSON Schema（pydantic の model_json_schema() など）
+        model (str): 使用するモデル名（デフォルト: LLM_MODEL。一次判定などには LLM_FAST_MODEL）
+        temperature (float): サンプリング温度（デフォルト: LLM_TEMPERATURE）
+        max_tokens (Optional[int]): 出力トークン数の上限（デフォルト: None）
+
+    Returns:
+        str: LLMからの応答テキスト
+
+    Raises:
+        LLMCallError: リトライを使い切っても呼び出しが成功しなかった場合
+        Exception: RETRYABLE_LLM_ERRORS 以外のエラー（認証エラー・不正なリクエストなど）
+    """
+    key: Optional[str] = None
+    if cache:
+        key = _cache_key(prompt, json_mode, system_prompt, json_schema, model, temperature, max_tokens)
+        if (cached_response := _cache_get(key)) is not None:
+            return cached_response
+
+        # 同じリクエストが実行中なら、ネットワークに出さずにその結果を待つ（single-flight）
+        if (inflight := _inflight_requests.get(key)) is not None:
+            return await asyncio.shield(inflight)
+        _inflight_requests[key] = asyncio.get_running_loop().create_future()
+
+    try:
+        response_text = await _ainvoke_llm(prompt, json_mode, max_retries, initial_backoff, system_prompt, json_schema, model, temperature, max_tokens)
+        if key is not None:
+            _cache_put(key, response_text)
+    except BaseException as e:
+        if key is not None:
+            inflight = _inflight_requests.pop(key)
+            if isinstance(e, Exception):
+                # リトライしても解決しないエラーは、待っている呼び出しにも同じ例外を伝える
+                # （待っている呼び出しがなくても未回収の例外として警告されないよう、ここで一度取り出しておく）
+                inflight.set_exception(e)
+                inflight.exception()
+            else:
+                # キャンセルされた場合は、待っている呼び出しもキャンセルする
+                inflight.cancel()
+        raise
+
+    if key is not None:
+        _inflight_requests.pop(key).set_result(response_text)
+    return response_text
+
+async def acall_llm_candidates(prompt: str, n: int, json_mode: bool = False, max_retries: int = 5, initial_backoff: float = 1.0, cache: bool = False, system_prompt: Optional[str] = None, json_schema: Optional[Dict[str, Any]] = None, model: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE) -> List[str]:
+    """
+    1回のリクエストで n 個の応答候補をサンプリングする（n パラメータ）。
+    プロンプトの処理はサーバー側で候補間で共有されるので、n 回呼び出すより安く速い。
+    リトライを使い切った場合は LLMCallError を送出する
+    （リトライしても解決しないエラーは acall_llm と同様にそのまま送出する）。
+
+    Args:
+        prompt (str): LLMに送信するプロンプト
+        n (int): 生成する候補の数
+        json_mode (bool): JSONモードを有効にするかどうか（デフォルト: False）
+        max_retries (int): 最大リトライ回数（デフォルト: 5）
+        initial_backoff (float): 初期バックオフ時間（秒）（デフォルト: 1.0）
+        cache (bool): ディスクキャッシュを使うかどうか（デフォルト: False）。候補のリストをまとめて保存する
+        system_prompt (Optional[str]): 呼び出し間で不変のシステムプロンプト
+        json_schema (Optional[Dict[str, Any]]): 出力を強制する JSON Schema
+        model (str): 使用するモデル名（デフォルト: LLM_MODEL）
+        temperature (float): サンプリング温度（デフォルト: LLM_TEMPERATURE）
+
+    Returns:
+        List[str]: LLMからの応答候補のリスト
+
+    Raises:
+        LLMCallError: リトライを使い切っても呼び出しが成功しなかった場合
+    """
+    key: Optional[str] = None
+    if cache:
+        key = _cache_key(prompt, json_mode, system_prompt, json_schema, model, temperature, None, n)
+        if (cached_response := _cache_get(key)) is not None:
+            return list(orjson.loads(cached_response))
+
+    llm = _build_llm(json_mode, json_schema, model, temperature, system_prompt=system_prompt)
+    messages = _build_messages(prompt, system_prompt)
+    # 出力は候補の数だけ生成されるので、TPM の見積もりにも反映する
+    estimated_tokens = _estimate_request_tokens(prompt, system_prompt, n * LLM_ESTIMATED_OUTPUT_TOKENS) if _token_limiter.enabled else 0
+
+    try:
+        async for attempt in AsyncRetrying(**_retry_policy(max_retries, initial_backoff)):
+            with attempt:
+                await _token_limiter.acquire(estimated_tokens)
+                async with _llm_limiter:
+                    result = await llm.agenerate([messages], n=n)
+    except RETRYABLE_LLM_ERRORS as e:
+        raise LLMCallError(f"LLM 呼び出しに失敗しました: {e}") from e
+    # agenerate の使用量は個々の候補ではなく llm_output にまとめて入る（入力トークンは候補間で共有される）
+    _record_token_usage((result.llm_output or {}).get("token_usage"))
+
+    candidates = [generation.text for generation in result.generations[0]]
+    if key is not None:
+        _cache_put(key, orjson.dumps(candidates).decode())
+    return candidates
+
+def _estimate_request_tokens(prompt: str, system_prompt: Optional[str], max_tokens: Optional[int]) -> int:
+    """
+    TPM 制限のために、1リクエストで消費するトークン数（入力 + 出力の上限）を見積もる
+    """
+    input_tokens = count_tokens(prompt) + (count_tokens(system_prompt) if system_prompt else 0)
+    return input_tokens + (max_tokens if max_tokens is not None else LLM_ESTIMATED_OUTPUT_TOKENS)
+
+async def _ainvoke_llm(prompt: str, json_mode: bool, max_retries: int, initial_backoff: float, system_prompt: Optional[str], json_schema: Optional[Dict[str, Any]], model: str, temperature: float, max_tokens: Optional[int]) -> str:
+    """
+    キャッシュを介さずに LLM を非同期で呼び出す。
+    リトライを使い切った場合は LLMCallError を、リトライ対象外のエラーはそのまま送出する
+    """
+    llm = _build_llm(json_mode, json_schema, model, temperature, max_tokens, system_prompt)
+    messages = _build_messages(prompt, system_prompt)
+    estimated_tokens = _estimate_request_tokens(prompt, system_prompt, max_tokens) if _token_limiter.enabled else 0
+
+    try:
+        async for attempt in AsyncRetrying(**_retry_policy(max_retries, initial_backoff)):
+            with attempt:
+                # リトライも TPM を消費するので、試行ごとにトークンを確保する
+                await _token_limiter.acquire(estimated_tokens)
+                # バックオフ中はリミッターを解放しているので、他のリクエストは進行できる
+                async with _llm_limiter:
+                    response = await llm.ainvoke(messages)
+    except RETRYABLE_LLM_ERRORS as e:
+        raise LLMCallError(f"LLM 呼び出しに失敗しました: {e}") from e
+    _record_prompt_usage(response)
+    return str(response.content)
+
+async def acall_llm_stream(prompt: str, json_mode: bool = False, max_retries: int = 5, initial_backoff: float = 1.0, system_prompt: Optional[str] = None, json_schema: Optional[Dict[str, Any]] = None, cache: bool = False, model: str = LLM_MODEL) -> AsyncIterator[str]:
+    """
+    acall_llm のストリーミング版。生成されたトークンを届いた順に返す。
+    最初のチャンクを受け取る前の失敗はリトライするが、途中で失敗した場合はリトライせずに LLMCallError を送出する。
+
+    Args:
+        prompt (str): LLMに送信するプロンプト
+        json_mode (bool): JSONモードを有効にするかどうか（デフォルト: False）
+        max_retries (int): 最大リトライ回数（デフォルト: 5）
+        initial_backoff (float): 初期バックオフ時間（秒）（デフォルト: 1.0）
+        system_prompt (Optional[str]): 呼び出し間で不変のシステムプロンプト
+        json_schema (Optional[Dict[str, Any]]): 出力を強制する JSON Schema
+        cache (bool): ディスクキャッシュを使うかどうか（デフォルト: False）。
+            キャッシュにあれば応答全体を1つの断片として返し、なければ最後まで受け取った応答を保存する
+        model (str): 使用するモデル名（デフォルト: LLM_MODEL）
+
+    Yields:
+        str: LLMからの応答テキストの断片
+
+    Raises:
+        LLMCallError: リトライを使い切った場合、または応答の途中で一時的なエラーが発生した場合
+    """
+    key: Optional[str] = None
+    if cache:
+        key = _cache_key(prompt, json_mode, system_prompt, json_schema, model, LLM_TEMPERATURE, None)
+        if (cached_response := _cache_get(key)) is not None:
+            yield cached_response
+            return
+
+    llm = _build_llm(json_mode, json_schema, model, system_prompt=system_prompt)
+    messages = _build_messages(prompt, system_prompt)
+    estimated_tokens = _estimate_request_tokens(prompt, system_prompt, None) if _token_limiter.enabled else 0
+    chunks: List[str] = []
+
+    # 一度でもチャンクを返した後は、呼び出し側に重複した出力を渡さないようリトライしない
+    started = False
+    not_started: Callable[[BaseException], bool] = lambda _: not started
+    policy = _retry_policy(max_retries, initial_backoff, retry_if_exception_type(RETRYABLE_LLM_ERRORS) & retry_if_exception(not_started))
+
+    try:
+        async for attempt in AsyncRetrying(**policy):
+            with attempt:
+                await _token_limiter.acquire(estimated_tokens)
+                async with _llm_limiter:
+                    async for chunk in llm.astream(messages):
+                        started = True
+                        if usage_metadata := getattr(chunk, "usage_metadata", None):
+                            _record_usage_metadata(usage_metadata)
+                        chunk_text = str(chunk.content)
+                        if key is not None:
+                            chunks.append(chunk_text)
+                        yield chunk_text
+    except RETRYABLE_LLM_ERRORS as e:
+        raise LLMCallError(f"LLM 呼び出しに失敗しました: {e}") from e
+
+    if key is not None:
+        _cache_put(key, "".join(chunks))
+
+# JSON 文字列の中で特別な意味を持つ文字（値の終わりの引用符とエスケープ）
+_JSON_STRING_SPECIAL = re.compile(r'[\\"]')
+
+class StreamingStringField:
+    """
+    acall_llm_stream で受け取る JSON テキストを監視し、指定したキーの文字列値が閉じた時点でその値を返す。
+    各チャンクは一度だけ走査し、値の断片はリストに溜めて閉じた時点で一度だけ連結する。
+    """
+    def __init__(self, key: str):
+        self._key_pattern = re.compile(rf'"{re.escape(key)}"\s*:\s*"')
+        # キーの途中までで切れている末尾（次のチャンクと合わせて一致する可能性がある部分）
+        self._partial_key_pattern = re.compile(rf'"{re.escape(key)}"\s*(?::\s*)?$')
+        self._max_key_prefix = len(key) + 1
+        # キーが見つかるまでの、まだ一致を判定しきれていない末尾
+        self._head = ""
+        self._value_started = False
+        self._value_chunks: List[str] = []
+        # 直前のチャンクがエスケープ文字で終わったかどうか
+        self._escaped = False
+        self.value: Optional[str] = None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """
+        チャンクを追加する。値がこのチャンクで閉じた場合のみデコード済みの値を返す
+        """
+        if self.value is not None:
+            return None
+        if self._value_started:
+            return self._scan_value(chunk)
+
+        head = self._head + chunk
+        match = self._key_pattern.search(head)
+        if match is None:
+            # キーの一部になり得る末尾だけを残し、走査済みの部分は捨てる
+            partial = self._partial_key_pattern.search(head)
+            self._head = head[partial.start():] if partial else head[-self._max_key_prefix:]
+            return None
+        self._head = ""
+        self._value_started = True
+        return self._scan_value(head[match.end():])
+
+    def _scan_value(self, text: str) -> Optional[str]:
+        """
+        値の断片を走査し、閉じる引用符が見つかればデコード済みの値を返す
+        """
+        i = 0
+        if self._escaped and text:
+            # 前のチャンク末尾のエスケープ文字に続く1文字は読み飛ばす
+            self._escaped = False
+            i = 1
+        while (special := _JSON_STRING_SPECIAL.search(text, i)) is not None:
+            j = special.start()
+            if text[j] == '"':
+                self._value_chunks.append(text[:j])
+                # 引用符で囲んで json.loads に渡し、エスケープを解釈させる
+                self.value = json.loads('"' + "".join(self._value_chunks) + '"')
+                return self.value
+            if j + 1 >= len(text):
+                self._escaped = True
+                break
+            i = j + 2
+        self._value_chunks.append(text)
+        return None
+
+def build_batch_job(custom_id: str, prompt: str, json_mode: bool = False, system_prompt: Optional[str] = None, model: str = LLM_MODEL) -> Dict[str, Any]:
+    """
+    Batch API に投入する1リクエスト分のジョブを組み立てる。
+    モデル・温度・メッセージ構成は call_llm / acall_llm と同じにする。
+
+    Args:
+        custom_id (str): 結果と対応づけるための一意なID（例: "style:01-02-003"）
+        prompt (str): LLMに送信するプロンプト
+        json_mode (bool): JSONモードを有効にするかどうか（デフォルト: False）
+        system_prompt (Optional[str]): 呼び出し間で不変のシステムプロンプト
+        model (str): 使用するモデル名（デフォルト: LLM_MODEL）
+
+    Returns:
+        Dict[str, Any]: Batch API の入力 JSONL の1行に相当する辞書
+    """
+    messages: List[Dict[str, str]] = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+
+    body: Dict[str, Any] = {
+        "model": model,
+        "temperature": LLM_TEMPERATURE,
+        "messages": messages,
     }
-    
-    # Add JSON mode if requested
     if json_mode:
-        llm_params["model_kwargs"]["response_format"] = {"type": "json_object"}
-    
-    # Initialize the OpenAI LLM
-    llm = ChatOpenAI(**llm_params)
-    
-    # Create a message with the prompt
-    message = HumanMessage(content=prompt)
-    
-    retries = 0
-    while True:
-        try:
-            # Get the response from the LLM
-            response = llm.invoke([message])
-            
-            # Return the content of the response as a string
-            return str(response.content)
-            
-        except Exception as e:
-            retries += 1
-            if retries > max_retries:
-                print(f"Failed after {max_retries} attempts. Last error: {e}")
-                return f"Error: リトライ ({max_retries}回) 後も失敗しました: {str(e)}"
-            
-            # Calculate backoff time with jitter to avoid thundering herd problem
-            backoff_time = initial_backoff * (2 ** (retries - 1)) * (0.5 + random.random())
-            print(f"Attempt {retries} failed with error: {e}. Retrying in {backoff_time:.2f} seconds...")
-            time.sleep(backoff_time) 
+        body["response_format"] = {"type": "json_object"}
+
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+@lru_cache(maxsize=1)
+def _batch_client() -> OpenAI:
+    """
+    Batch API 用の OpenAI クライアントを返す。
+    章・セクション・スタイルごとの batch_llm 呼び出しで同じクライアント（と HTTP 接続プール）を使い回す。
+    OpenAI SDK は httpx2 のクライアントを受け取るので、共有の HTTP クライアントと同じ設定で別に作る
+    """
+    http_client = DefaultHttpxClient(
+        limits=httpx2.Limits(
+            max_connections=LLM_HTTP_LIMITS.max_connections,
+            max_keepalive_connections=LLM_HTTP_LIMITS.max_keepalive_connections,
+            keepalive_expiry=LLM_HTTP_LIMITS.keepalive_expiry,
+        ),
+        timeout=httpx2.Timeout(
+            connect=LLM_HTTP_TIMEOUT.connect,
+            read=LLM_HTTP_TIMEOUT.read,
+            write=LLM_HTTP_TIMEOUT.write,
+            pool=LLM_HTTP_TIMEOUT.pool,
+        ),
+        http2=True,
+    )
+    atexit.register(http_client.close)
+    return OpenAI(http_client=http_client)
+
+def batch_llm(jobs: List[Dict[str, Any]], poll_interval: float = 30.0) -> List[str]:
+    """
+    OpenAI Batch API でジョブをまとめて実行し、完了まで待って応答を返す。
+    通常の呼び出しより安価だが完了まで時間がかかる（最大24時間）ため、非対話実行向け。
+    ブロッキングでポーリングするので、非同期コードからは asyncio.to_thread 経由で呼ぶこと。
+
+    Args:
+        jobs (List[Dict[str, Any]]): build_batch_job で作ったジョブのリスト
+        poll_interval (float): ステータス確認の間隔（秒）（デフォルト: 30.0）
+
+    Returns:
+        List[str]: jobs と同じ順序の応答テキスト。個別に失敗したものは "Error: ..." になる
+
+    Raises:
+        RuntimeError: バッチ全体が完了しなかった場合
+    """
+    if not jobs:
+        return []
+
+    client = _batch_client()
+    batch_input = "\n".join(json.dumps(job, ensure_ascii=False) for job in jobs)
+    input_file = client.files.create(file=("batch_input.jsonl", batch_input.encode("utf-8")), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted batch {batch.id} with {len(jobs)} requests")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or batch.output_file_id is None:
+        raise RuntimeError(f"Batch {batch.id} finished with status '{batch.status}'")
+
+    results: Dict[str, str] = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            results[record["custom_id"]] = f"Error: バッチリクエストが失敗しました: {record.get('error') or response.get('body')}"
+        else:
+            results[record["custom_id"]] = str(response["body"]["choices"][0]["message"]["content"])
+
+    return [results.get(job["custom_id"], "Error: バッチ結果が見つかりません") for job in jobs]